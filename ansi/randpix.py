@@ -1,11 +1,120 @@
 #!/usr/bin/env python3
 
-from sys import stdout
-from time import sleep
+import asyncio
+import os
+import sixel
+import termios
+import tty
+
+from functools import lru_cache
+from sys import argv, stdin, stdout
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 write = stdout.write
 flush = stdout.flush
 
+# color depths: 24-bit, the 256 colors of xterm and the 16 ANSI colors
+TRUECOLOR = 'truecolor'
+XTERM256 = '256'
+ANSI16 = '16'
+
+# levels of red, green and blue in the xterm 6x6x6 color cube
+CUBE = (0, 95, 135, 175, 215, 255)
+# nearest cube level of each channel value
+CUBE_INDEX = bytes(min(range(6), key=lambda i: abs(CUBE[i] - v)) for v in range(256))
+# r, g, b of the 16 ANSI colors as xterm shows them
+ANSI = ((0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0), (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+        (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0), (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255))
+# channel values as decimal bytes, so truecolor escapes need no formatting
+DECIMAL = [b'%d' % v for v in range(256)]
+# escapes of each palette index, for fg (38) and bg (48)
+PALETTE_ESCAPES = {
+  (38, XTERM256): [b"\033[38;5;%dm" % i for i in range(256)],
+  (48, XTERM256): [b"\033[48;5;%dm" % i for i in range(256)],
+  (38, ANSI16): [b"\033[%dm" % (30 + i if i < 8 else 82 + i) for i in range(16)],
+  (48, ANSI16): [b"\033[%dm" % (40 + i if i < 8 else 92 + i) for i in range(16)],
+}
+# escapes of this many colors are kept
+ESCAPE_CACHE = 1 << 16
+
+
+def detect_depth():
+  # the color depth the terminal claims
+  if os.environ.get('COLORTERM') in ('truecolor', '24bit'):
+    return TRUECOLOR
+  if '256' in os.environ.get('TERM', ''):
+    return XTERM256
+  return ANSI16
+
+
+# color depth the escapes are made for, see set_depth
+depth = detect_depth()
+
+
+def set_depth(new_depth):
+  global depth
+  depth = new_depth
+
+
+@lru_cache(maxsize=ESCAPE_CACHE)
+def palette_color(packed, depth):
+  # (palette index, packed r, g, b) of the color nearest to packed r, g, b
+  # (r << 16 | g << 8 | b) at depth
+  r, g, b = packed >> 16, packed >> 8 & 0xff, packed & 0xff
+  if depth == TRUECOLOR:
+    return (None, packed)
+  if depth == ANSI16:
+    i = min(range(16), key=lambda i: (ANSI[i][0] - r)**2 + (ANSI[i][1] - g)**2 + (ANSI[i][2] - b)**2)
+    return (i, ANSI[i][0] << 16 | ANSI[i][1] << 8 | ANSI[i][2])
+  # the nearer of the cube color and the grey of the same brightness
+  ci = (CUBE_INDEX[r], CUBE_INDEX[g], CUBE_INDEX[b])
+  cube = (CUBE[ci[0]], CUBE[ci[1]], CUBE[ci[2]])
+  k = min(max(round(((r + g + b) / 3 - 8) / 10), 0), 23)
+  grey = 8 + 10*k
+  if (grey - r)**2 + (grey - g)**2 + (grey - b)**2 < (cube[0] - r)**2 + (cube[1] - g)**2 + (cube[2] - b)**2:
+    return (232 + k, grey * 0x10101)
+  return (16 + 36*ci[0] + 6*ci[1] + ci[2], cube[0] << 16 | cube[1] << 8 | cube[2])
+
+
+@lru_cache(maxsize=ESCAPE_CACHE)
+def color_escape(layer, packed, depth):
+  # bytes setting the fg (layer 38) or bg (layer 48) to packed r, g, b
+  if depth == TRUECOLOR:
+    return b"\033[%d;2;" % layer + DECIMAL[packed >> 16] + b';' + DECIMAL[packed >> 8 & 0xff] + b';' + DECIMAL[packed & 0xff] + b'm'
+  return PALETTE_ESCAPES[(layer, depth)][palette_color(packed, depth)[0]]
+
+
+@lru_cache(maxsize=ESCAPE_CACHE)
+def color_text(layer, r, g, b, depth):
+  # color_escape as text, for writing to stdout
+  return color_escape(layer, r << 16 | g << 8 | b, depth).decode()
+
+
+def quantize(pixels, depth):
+  """Packed r, g, b of the color nearest to each pixel at depth
+
+  pixels is a numpy array of r, g, b bytes, quantized in one go into a
+  numpy array, or rows of r, g, b pixels, quantized one by one into rows.
+  """
+  if numpy is None or not isinstance(pixels, numpy.ndarray):
+    return [[palette_color(r << 16 | g << 8 | b, depth)[1] for r, g, b in row] for row in pixels]
+  pixels = pixels[..., :3].astype(numpy.int32)
+  if depth == XTERM256:
+    cube = numpy.array(CUBE)[numpy.frombuffer(CUBE_INDEX, numpy.uint8)[pixels]]
+    grey = 8 + 10 * numpy.clip(numpy.round((pixels.sum(axis=-1) / 3 - 8) / 10), 0, 23).astype(numpy.int32)
+    greys = numpy.repeat(grey[..., None], 3, axis=-1)
+    nearer = ((greys - pixels)**2).sum(axis=-1) < ((cube - pixels)**2).sum(axis=-1)
+    pixels = numpy.where(nearer[..., None], greys, cube)
+  elif depth == ANSI16:
+    ansi = numpy.array(ANSI)
+    pixels = ansi[((pixels[..., None, :] - ansi)**2).sum(axis=-1).argmin(axis=-1)]
+  return pixels[..., 0] << 16 | pixels[..., 1] << 8 | pixels[..., 2]
+
+
 class fg:
   black = "\u001b[30m"
   red = "\u001b[31m"
@@ -16,7 +125,7 @@ class fg:
   cyan = "\u001b[36m"
   white = "\u001b[37m"
 
-  def rgb(r, g, b): return f"\u001b[38;2;{r};{g};{b}m"
+  def rgb(r, g, b): return color_text(38, r, g, b, depth)
 
 class bg:
   black = "\u001b[40m"
@@ -28,7 +137,7 @@ class bg:
   cyan = "\u001b[46m"
   white = "\u001b[47m"
 
-  def rgb(r, g, b): return f"\u001b[48;2;{r};{g};{b}m"
+  def rgb(r, g, b): return color_text(48, r, g, b, depth)
 
 class util:
   # attributes
@@ -87,9 +196,207 @@ class util:
     util.to(x, y)
     write(util.sixel_begin+f"#0;2;{r};{g};{b}#0!{repeat}{ch}"+util.sixel_end)
 
+  def set_image(x, y, image, colors=256):
+    # image is rows of r,g,b pixels, a numpy array or a PIL image, each
+    # r,g,b ranging 0 to 255, sent as one sixel sequence
+    util.to(x, y)
+    flush()
+    stdout.buffer.write(sixel.encode(image, colors))
+
+class Frame:
+  """Grid of pixels drawn a frame at a time, each in a single os.write
+
+  Pixels set are only kept until show, which sends what changed since the
+  last frame shown: cursor moves only where the changed cells are not next
+  to each other, and colors only where they change.  Colors are taken to
+  the nearest the color depth shows as they are set, so changes too small
+  to show are not sent.
+  """
+
+  # cell flag of a blinking pixel, above its packed r, g, b
+  BLINK = 1 << 24
+
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    # packed r, g, b and BLINK of the pixel in each cell, row by row, None
+    # for none
+    self.cells = [None] * (width * height)
+    self.shown = [None] * (width * height)
+
+  def set_pixel(self, x, y, rgb=(255, 255, 255), blink=False):
+    # x, y from 0 at the upper left corner, r,g,b each range 0 to 255
+    if 0 <= x < self.width and 0 <= y < self.height:
+      r, g, b = rgb
+      self.cells[y*self.width + x] = palette_color(r << 16 | g << 8 | b, depth)[1] | (self.BLINK if blink else 0)
+
+  def blit(self, x, y, pixels, blink=False):
+    # set rows of r, g, b pixels, or a numpy array of them, with their
+    # upper left corner at x, y, quantized all at once
+    flag = self.BLINK if blink else 0
+    rows = quantize(pixels, depth)
+    for i, row in enumerate(rows.tolist() if not isinstance(rows, list) else rows):
+      if 0 <= y+i < self.height:
+        start = max(0, -x)
+        row = row[start:max(start, self.width - x)]
+        at = (y+i)*self.width + x + start
+        self.cells[at:at+len(row)] = [packed | flag for packed in row]
+
+  def clear(self):
+    self.cells = [None] * (self.width * self.height)
+
+  def render(self):
+    # escape sequences taking the screen from the last frame to this one
+    out = []
+    # where the cursor is and the cell whose colors are in use, None until
+    # set and -1 after a reset
+    cursor = None
+    sgr = None
+    for i, cell in enumerate(self.cells):
+      if cell == self.shown[i]:
+        continue
+      y, x = divmod(i, self.width)
+      if cursor is None or cursor[0] != y or cursor[1] > x:
+        out.append(b"\033[%d;%dH" % (y+1, x+1))
+      elif cursor[1] < x:
+        out.append(b"\033[%dC" % (x-cursor[1]))
+      if cell is None:
+        if sgr != -1:
+          out.append(b"\033[0m")
+          sgr = -1
+        out.append(b' ')
+      else:
+        if sgr != cell:
+          unknown = sgr is None or sgr == -1
+          escape = color_escape(38, cell & 0xffffff, depth) if unknown or (sgr ^ cell) & 0xffffff else None
+          if unknown or (sgr ^ cell) & self.BLINK:
+            blink = b"5" if cell & self.BLINK else b"25"
+            # one escape for both, where the color changes too
+            escape = b"\033[" + blink + (b";" + escape[2:] if escape is not None else b"m")
+          out.append(escape)
+          sgr = cell
+        out.append(b'@')
+      cursor = (y, x+1)
+    return b''.join(out)
+
+  def swap(self):
+    # escapes of the frame, which is taken as shown from here on
+    payload = self.render()
+    self.shown = list(self.cells)
+    return payload
+
+  def show(self):
+    # draw the frame, returning the bytes it took
+    flush()
+    payload = memoryview(self.swap())
+    size = len(payload)
+    while len(payload) > 0:
+      payload = payload[os.write(stdout.fileno(), payload):]
+    return size
+
+class Animation:
+  """Frame drawn fps times a second on asyncio, with keys read meanwhile
+
+  Each frame's escapes go to a writer fed as the terminal takes them, so
+  frame n+1 is set while frame n is still being written.  A frame due
+  while the last one is still being written is dropped, its changes going
+  out with the next one shown; frames due while update ran late are
+  skipped, keeping the animation to the clock.  Keys are read in raw mode.
+  """
+
+  def __init__(self, frame, fps=30):
+    self.frame = frame
+    self.fps = fps
+    self.running = False
+    # frames written and frames dropped or skipped
+    self.shown = 0
+    self.dropped = 0
+    # escapes of the frame being written, not yet taken by the terminal
+    self.pending = memoryview(b'')
+
+  def stop(self):
+    self.running = False
+
+  def write(self):
+    # write what the terminal takes without blocking, until it took all
+    try:
+      self.pending = self.pending[os.write(stdout.fileno(), self.pending):]
+    except BlockingIOError:
+      pass
+    if len(self.pending) == 0:
+      self.loop.remove_writer(stdout.fileno())
+
+  def read(self, on_key):
+    try:
+      keys = os.read(stdin.fileno(), 64)
+    except BlockingIOError:
+      # stdin shares its file with stdout when both are the terminal
+      return
+    # raw mode takes ctrl-c as a key
+    if b'\x03' in keys:
+      self.stop()
+    elif len(keys) > 0:
+      on_key(keys)
+
+  async def run(self, update, on_key=None):
+    """Animate until stop is called or update returns False
+
+    update(frame, n) sets the pixels of frame n, n counting the frames
+    skipped too.  on_key(keys) is called with the bytes of each key or
+    escape sequence typed.
+    """
+    self.loop = asyncio.get_running_loop()
+    out = stdout.fileno()
+    flush()
+    blocking = os.get_blocking(out)
+    os.set_blocking(out, False)
+    mode = None
+    if on_key is not None and os.isatty(stdin.fileno()):
+      mode = termios.tcgetattr(stdin.fileno())
+      tty.setraw(stdin.fileno())
+      self.loop.add_reader(stdin.fileno(), self.read, on_key)
+    self.running = True
+    due = self.loop.time()
+    n = 0
+    try:
+      while self.running:
+        if update(self.frame, n) is False:
+          break
+        n += 1
+        if len(self.pending) > 0:
+          # the terminal is behind, so this frame's changes wait for the next
+          self.dropped += 1
+        else:
+          self.pending = memoryview(self.frame.swap())
+          self.shown += 1
+          self.write()
+          if len(self.pending) > 0:
+            self.loop.add_writer(out, self.write)
+        due += 1 / self.fps
+        late = self.loop.time() - due
+        if late > 0:
+          missed = int(late * self.fps) + 1
+          self.dropped += missed
+          n += missed
+          due += missed / self.fps
+        await asyncio.sleep(due - self.loop.time())
+      while len(self.pending) > 0:
+        await asyncio.sleep(1 / self.fps)
+    finally:
+      self.running = False
+      self.loop.remove_writer(out)
+      if mode is not None:
+        self.loop.remove_reader(stdin.fileno())
+        termios.tcsetattr(stdin.fileno(), termios.TCSADRAIN, mode)
+      os.set_blocking(out, blocking)
 
 if __name__ == '__main__':
 
+  # --depth=truecolor, 256 or 16 overrides the depth the terminal claims
+  for arg in argv[1:]:
+    if arg.startswith('--depth='):
+      set_depth(arg[len('--depth='):])
+
   util.init()
 
   # grey scale
@@ -102,14 +409,9 @@ if __name__ == '__main__':
     for x in range(y+1):
       util.set_sixel(x, y, (y-x, x, 100-y), 6)
 
-  # a faster one
-  for y in range(101):
-    util.to(0, y)
-    write(util.sixel_begin)
-    for x in range(y+1):
-      write(f"#{x};2;{y-x};{x};{100-y}#{x}!3~")
-    write("-")
-    write(util.sixel_end)
+  # a faster one, the whole triangle in one sixel sequence
+  triangle = [[(255*(y-x)//100, 255*x//100, 255*(100-y)//100) if x <= y else (0, 0, 0) for x in range(101) for _ in range(3)] for y in range(101) for _ in range(6)]
+  util.set_image(0, 0, triangle)
 
   util.pause()
 
@@ -145,4 +447,34 @@ if __name__ == '__main__':
 
   util.pause()
 
+  # random pixels a frame at a time, changing a tenth of them each frame,
+  # + and - changing the frame rate, space pausing, q or enter ending it
+  animation = Animation(Frame(50, 20), fps=10)
+  paused = False
+
+  def update(frame, n):
+    if paused and n > 0:
+      return
+    for i in range(0,20):
+      for j in range(0,50):
+        if n == 0 or random.random() < 0.1:
+          r = random.randrange(256)
+          g = random.randrange(256)
+          b = random.randrange(256)
+          frame.set_pixel(j, i, (r, g, b))
+
+  def on_key(keys):
+    global paused
+    if keys in (b'q', b'\r'):
+      animation.stop()
+    elif keys == b' ':
+      paused = not paused
+    elif keys == b'+':
+      animation.fps = min(animation.fps * 2, 240)
+    elif keys == b'-':
+      animation.fps = max(animation.fps / 2, 1)
+
+  asyncio.run(animation.run(update, on_key))
+
   util.end()
+  print(f"{animation.shown} frames shown, {animation.dropped} dropped")
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import hashlib
+import heapq
+import re
+import time
+
+from collections import Counter, OrderedDict
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# device control strings around the sixels, as in randpix
+SIXEL_BEGIN = b"\033Pq"
+SIXEL_END = b"\033\\"
+# encodings kept, by image, for drawing static images again
+CACHE_SIZE = 32
+# a run of a sixel this long or longer is sent as !n
+RUN = 4
+# with more colors than the palette holds, colors are cut into it with
+# the lower 3 bits of red, green and blue taken as the middle of their range
+COARSE = 0xf8
+
+cache = OrderedDict()
+
+
+def image_bytes(image):
+  # (height, width, r, g, b bytes) of a numpy height x width x 3 array, a
+  # PIL image or rows of r, g, b pixels, each ranging from 0 to 255
+  if hasattr(image, 'convert') and hasattr(image, 'size'):
+    image = image.convert('RGB')
+    width, height = image.size
+    return (height, width, image.tobytes())
+  if numpy is not None and isinstance(image, numpy.ndarray):
+    height, width = image.shape[:2]
+    return (height, width, numpy.ascontiguousarray(image[..., :3], dtype=numpy.uint8).tobytes())
+  rows = [row for row in image]
+  width = len(rows[0]) if len(rows) > 0 else 0
+  return (len(rows), width, bytes(v for row in rows for rgb in row for v in rgb[:3]))
+
+
+def median_cut(colors, counts, n):
+  """Palette of at most n colors for colors counted counts times
+
+  The colors, all different, start in one box, and the box spanning the
+  widest range of red, green or blue is cut in two at the median pixel
+  along it until there are n boxes or no box can be cut.  Returns the
+  palette, the mean of each box, and the palette index of each color.
+  """
+  if numpy is not None and isinstance(colors, numpy.ndarray):
+    def spread(box):
+      ranges = colors[box].max(axis=0) - colors[box].min(axis=0)
+      return (-int(ranges.max()), int(ranges.argmax()))
+    def cut(box, channel):
+      box = box[numpy.argsort(colors[box, channel], kind='stable')]
+      total = numpy.cumsum(counts[box])
+      at = int(numpy.searchsorted(total, total[-1] / 2))
+      return box[:max(1, at)], box[max(1, at):]
+    boxes = [numpy.arange(0, len(colors))]
+  else:
+    def spread(box):
+      ranges = [max(colors[i][c] for i in box) - min(colors[i][c] for i in box) for c in range(0, 3)]
+      return (-max(ranges), ranges.index(max(ranges)))
+    def cut(box, channel):
+      box = sorted(box, key=lambda i: colors[i][channel])
+      half = sum(counts[i] for i in box) / 2
+      at = 0
+      total = 0
+      while total + counts[box[at]] < half:
+        total += counts[box[at]]
+        at += 1
+      return box[:max(1, at)], box[max(1, at):]
+    boxes = [list(range(0, len(colors)))]
+  # boxes by how widely they spread, the widest first
+  heap = [spread(boxes[0]) + (0,)]
+  while len(boxes) < n and len(heap) > 0 and heap[0][0] < 0:
+    _, channel, i = heapq.heappop(heap)
+    boxes[i], box = cut(boxes[i], channel)
+    boxes.append(box)
+    for j in (i, len(boxes) - 1):
+      if len(boxes[j]) > 1:
+        heapq.heappush(heap, spread(boxes[j]) + (j,))
+  if numpy is not None and isinstance(colors, numpy.ndarray):
+    palette = [tuple(int(v) for v in (colors[box] * counts[box, None]).sum(axis=0) // counts[box].sum()) for box in boxes]
+    index = numpy.empty(len(colors), numpy.uint8)
+    for i, box in enumerate(boxes):
+      index[box] = i
+    return (palette, index)
+  palette = []
+  index = [0] * len(colors)
+  for i, box in enumerate(boxes):
+    weight = sum(counts[j] for j in box)
+    palette.append(tuple(sum(colors[j][c] * counts[j] for j in box) // weight for c in range(0, 3)))
+    for j in box:
+      index[j] = i
+  return (palette, index)
+
+
+def quantize(height, width, data, colors=256):
+  # (palette, palette index of each pixel, row by row) of r, g, b bytes
+  if numpy is not None:
+    pixels = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3).astype(numpy.uint32)
+    keys = pixels[:, 0] << 16 | pixels[:, 1] << 8 | pixels[:, 2]
+    unique, inverse, counts = numpy.unique(keys, return_inverse=True, return_counts=True)
+    if len(unique) > colors:
+      coarse = COARSE * 0x10101
+      keys = keys & coarse | (~coarse & 0xffffff) >> 1 & 0x7f7f7f
+      unique, inverse, counts = numpy.unique(keys, return_inverse=True, return_counts=True)
+    unique = numpy.stack([unique >> 16, unique >> 8 & 0xff, unique & 0xff], axis=1).astype(numpy.int64)
+    palette, index = median_cut(unique, counts, colors)
+    return (palette, index[inverse.reshape(-1)].reshape(height, width))
+  pixels = list(zip(data[0::3], data[1::3], data[2::3]))
+  counts = Counter(pixels)
+  if len(counts) > colors:
+    middle = (~COARSE & 0xff) >> 1
+    pixels = [(r & COARSE | middle, g & COARSE | middle, b & COARSE | middle) for r, g, b in pixels]
+    counts = Counter(pixels)
+  # in the order numpy.unique gives, for the same palette either way
+  unique = sorted(counts)
+  palette, index = median_cut(unique, [counts[rgb] for rgb in unique], colors)
+  lookup = dict(zip(unique, index))
+  indexes = bytes(lookup[rgb] for rgb in pixels)
+  return (palette, [indexes[y * width:(y + 1) * width] for y in range(0, height)])
+
+
+def run_length(match):
+  return b'!%d%c' % (len(match.group()), match.group()[0])
+
+
+runs = re.compile(rb'(.)\1{%d,}' % (RUN - 1), re.S).sub
+
+
+def encode_bands(indexes, height, width):
+  # sixel data of the pixels, 6 lines a band, each band a line of sixels
+  # for each color in it, the lines after the first going back to its
+  # start with $
+  bands = []
+  for top in range(0, height, 6):
+    planes = []
+    if numpy is not None and isinstance(indexes, numpy.ndarray):
+      band = indexes[top:top + 6]
+      # a plane of sixels for each color in the band, all set in one go
+      present = numpy.unique(band)
+      rank = numpy.searchsorted(present, band)
+      sixels = numpy.full((len(present), width), 63, numpy.uint8)
+      columns = numpy.arange(0, width)
+      for j in range(0, len(band)):
+        sixels[rank[j], columns] += 1 << j
+      for c, plane in zip(present.tolist(), sixels):
+        planes.append(b'#%d' % c + runs(run_length, plane.tobytes().rstrip(b'?')))
+    else:
+      by_color = {}
+      for j, row in enumerate(indexes[top:top + 6]):
+        bit = 1 << j
+        for x, c in enumerate(row):
+          if c not in by_color:
+            by_color[c] = bytearray(width)
+          by_color[c][x] |= bit
+      for c in sorted(by_color):
+        plane = bytes(v + 63 for v in by_color[c])
+        planes.append(b'#%d' % c + runs(run_length, plane.rstrip(b'?')))
+    bands.append(b'$'.join(planes))
+  return b'-'.join(bands)
+
+
+def encode(image, colors=256):
+  """Sixels of an image, one device control string to write at the cursor
+
+  image is a numpy height x width x 3 array of bytes, a PIL image or rows
+  of r, g, b pixels ranging from 0 to 255.  It is quantized to at most
+  colors colors with median_cut, and runs of a sixel are sent once with
+  their length.  The encodings of the last CACHE_SIZE images are kept, so
+  drawing a static image again only hashes it.
+  """
+  height, width, data = image_bytes(image)
+  colors = min(colors, 256)
+  key = (height, width, colors, hashlib.blake2b(data, digest_size=16).digest())
+  if key in cache:
+    cache.move_to_end(key)
+    return cache[key]
+  palette, indexes = quantize(height, width, data, colors)
+  # colors are given in percent
+  header = b'"1;1;%d;%d' % (width, height) + b''.join(b'#%d;2;%d;%d;%d' % ((i,) + tuple((v * 100 + 127) // 255 for v in rgb)) for i, rgb in enumerate(palette))
+  sixels = SIXEL_BEGIN + header + encode_bands(indexes, height, width) + SIXEL_END
+  cache[key] = sixels
+  if len(cache) > CACHE_SIZE:
+    cache.popitem(last=False)
+  return sixels
+
+
+if __name__ == '__main__':
+
+  import sys
+
+  # a gradient with more colors than a palette holds, encoded over and over
+  height, width = 240, 320
+  image = [[(255*x//width, 255*y//height, 255*(x+y)//(width+height)) for x in range(0, width)] for y in range(0, height)]
+  if numpy is not None:
+    image = numpy.array(image, dtype=numpy.uint8)
+
+  sixels = encode(image)
+  sys.stdout.buffer.write(sixels + b'\n')
+  sys.stdout.flush()
+
+  times = []
+  for i in range(0, 5):
+    cache.clear()
+    start = time.perf_counter()
+    encode(image)
+    times.append(time.perf_counter() - start)
+  start = time.perf_counter()
+  encode(image)
+  cached = time.perf_counter() - start
+
+  best = min(times)
+  print('%dx%d: %d bytes in %.1f ms, %.1f MB/s; cached %.3f ms' % (width, height, len(sixels), best * 1e3, len(sixels) / best / 1e6, cached * 1e3))
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+# Throughput of the ansi and ncurses renderers, run headless.
+#
+# Every case runs in a child process drawing frames into a pseudo-terminal,
+# or with --sink=null into a pipe, which this process drains and counts.
+# The child times each frame and reports back on a pipe of its own.  For
+# each case, pixels/s, bytes per frame and frame latency percentiles are
+# printed and saved as JSON; --compare with the JSON of an older version
+# shows what got faster or slower.
+
+import argparse
+import fcntl
+import json
+import os
+import platform
+import pty
+import random
+import struct
+import subprocess
+import sys
+import termios
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# where results are saved unless told otherwise, ignored by git
+RESULTS = os.path.join(ROOT, 'bench', 'results')
+
+# written by a child around its frames, so setting up and ending the
+# terminal are not counted as frame bytes
+START = b'\033]9999;bench-start\007'
+END = b'\033]9999;bench-end\007'
+
+# frames of colors drawn in turn, so no time goes on random numbers
+PATTERNS = 4
+
+
+def patterns(width, height, top):
+  # PATTERNS frames of rows of random r, g, b, each ranging 0 to top
+  rand = random.Random(1)
+  return [[[(rand.randint(0, top), rand.randint(0, top), rand.randint(0, top)) for x in range(0, width)] for y in range(0, height)] for n in range(0, PATTERNS)]
+
+
+# Each case sets up its renderer and returns (draw a frame, pixels drawn a
+# frame, end), drawing into a terminal of width x height cells.
+
+def ansi_set_pixel(width, height):
+  import randpix
+  frames = patterns(width, height, 255)
+  def frame(n):
+    colors = frames[n % PATTERNS]
+    for y in range(0, height):
+      for x in range(0, width):
+        randpix.util.set_pixel(x+1, y+1, colors[y][x])
+    randpix.flush()
+  randpix.util.init()
+  return (frame, width*height, randpix.util.end)
+
+
+def ansi_set_sixel(width, height):
+  import randpix
+  # a run of sixels 32 pixels wide every 4 cells
+  frames = patterns(width//4, height, 100)
+  def frame(n):
+    colors = frames[n % PATTERNS]
+    for y in range(0, height):
+      for x in range(0, width//4):
+        randpix.util.set_sixel(4*x+1, y+1, colors[y][x], 32)
+    randpix.flush()
+  randpix.util.init()
+  return (frame, (width//4)*height*32*6, randpix.util.end)
+
+
+def ansi_frame(width, height):
+  import randpix
+  frames = patterns(width, height, 255)
+  screen = randpix.Frame(width, height)
+  def frame(n):
+    colors = frames[n % PATTERNS]
+    for y in range(0, height):
+      for x in range(0, width):
+        screen.set_pixel(x, y, colors[y][x])
+    screen.show()
+  randpix.util.init()
+  return (frame, width*height, randpix.util.end)
+
+
+def ansi_image(width, height):
+  import randpix
+  import sixel
+  # an image of 2 x 6 pixels a cell, a band of sixels a line, encoded anew
+  # every frame
+  frames = [[[rgb for rgb in row for _ in range(0, 2)] for row in rows for _ in range(0, 6)] for rows in patterns(width, height, 255)]
+  def frame(n):
+    sixel.cache.clear()
+    randpix.util.set_image(1, 1, frames[n % PATTERNS])
+  randpix.util.init()
+  return (frame, width*2*height*6, randpix.util.end)
+
+
+def pixman_set_pixel(width, height):
+  import pixman
+  frames = patterns(width, height, 5)
+  ds = pixman.DisplayServer()
+  pb = ds.pixel_buffers[0]
+  def frame(n):
+    colors = frames[n % PATTERNS]
+    for y in range(0, height):
+      for x in range(0, width):
+        pb.set_pixel(y, x, colors[y][x])
+    ds.flush()
+  return (frame, width*height, ds.end)
+
+
+def pixman_set_sixel(width, height):
+  import pixman
+  # a sixel 8 pixels wide every 8 cells of every 6 lines
+  frames = patterns(width//8, height//6, 5)
+  ds = pixman.DisplayServer()
+  pb = ds.pixel_buffers[0]
+  def frame(n):
+    colors = frames[n % PATTERNS]
+    for y in range(0, height//6):
+      for x in range(0, width//8):
+        pb.set_sixel(6*y, 8*x, colors[y][x], 8)
+    ds.flush()
+  return (frame, (width//8)*(height//6)*8*6, ds.end)
+
+
+def pixman_blit(width, height):
+  import pixman
+  frames = patterns(width, height, 255)
+  if pixman.numpy is not None:
+    frames = [pixman.numpy.array(rows, dtype=pixman.numpy.uint8) for rows in frames]
+  ds = pixman.DisplayServer()
+  pb = ds.pixel_buffers[0]
+  def frame(n):
+    pb.blit(frames[n % PATTERNS], dither=True)
+    ds.flush()
+  return (frame, width*height, ds.end)
+
+
+CASES = {
+  'ansi.set_pixel': ('ansi', ansi_set_pixel),
+  'ansi.set_sixel': ('ansi', ansi_set_sixel),
+  'ansi.frame': ('ansi', ansi_frame),
+  'ansi.image': ('ansi', ansi_image),
+  'pixman.set_pixel': ('ncurses', pixman_set_pixel),
+  'pixman.set_sixel': ('ncurses', pixman_set_sixel),
+  'pixman.blit': ('ncurses', pixman_blit),
+}
+
+
+def child(case, width, height, frames, result_fd):
+  # draw the frames of a case to stdout, reporting each frame's seconds
+  sys.path.insert(0, os.path.join(ROOT, CASES[case][0]))
+  frame, pixels, end = CASES[case][1](width, height)
+  sys.stdout.flush()
+  os.write(1, START)
+  times = []
+  for n in range(0, frames):
+    start = time.perf_counter()
+    frame(n)
+    times.append(time.perf_counter() - start)
+  os.write(1, END)
+  try:
+    end()
+  except Exception:
+    # curses keeps its terminal modes on stdout, so it cannot put them
+    # back when drawing into a pipe
+    if os.isatty(1):
+      raise
+  with os.fdopen(result_fd, 'w') as f:
+    json.dump({'pixels': pixels, 'times': times}, f)
+
+
+def percentile(values, p):
+  # nearest rank
+  values = sorted(values)
+  return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def drain(fd, counts):
+  # read fd to its end, noting how many bytes came before START and END
+  tail = b''
+  total = 0
+  while True:
+    try:
+      data = os.read(fd, 1 << 16)
+    except OSError:
+      # a pty reads EIO once the child is gone
+      break
+    if len(data) == 0:
+      break
+    # a marker may be split across reads
+    seen = tail + data
+    for marker in (START, END):
+      at = seen.find(marker)
+      if at >= 0 and marker not in counts:
+        counts[marker] = total - len(tail) + at + len(marker)
+    total += len(data)
+    tail = seen[-len(START):]
+  counts['total'] = total
+
+
+def run(case, sink, width, height, frames):
+  # run a case in a child and measure it
+  master, slave = pty.openpty()
+  fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', height, width, 0, 0))
+  if sink == 'null':
+    out, out_w = os.pipe()
+  else:
+    out, out_w = master, slave
+  result_r, result_w = os.pipe()
+  env = dict(os.environ, TERM='xterm-256color', COLORTERM='truecolor', LINES=str(height), COLUMNS=str(width), LANG=os.environ.get('LANG', 'C.UTF-8'))
+  # curses needs a terminal to read from, even drawing into a pipe
+  proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', case, '--size', '%dx%d' % (width, height), '--frames', str(frames), '--result-fd', str(result_w)],
+                          stdin=slave, stdout=out_w, stderr=subprocess.PIPE, pass_fds=(result_w,), env=env)
+  os.close(result_w)
+  os.close(slave)
+  if out_w != slave:
+    os.close(out_w)
+  counts = {}
+  reader = threading.Thread(target=drain, args=(out, counts))
+  reader.start()
+  with os.fdopen(result_r) as f:
+    report = f.read()
+  errors = proc.stderr.read().decode(errors='replace')
+  proc.wait()
+  reader.join()
+  os.close(out)
+  if out != master:
+    os.close(master)
+  if proc.returncode != 0 or len(report) == 0:
+    raise RuntimeError(case + ' failed:\n' + errors)
+  report = json.loads(report)
+  times = report['times']
+  frame_bytes = counts.get(END, 0) - len(END) - counts.get(START, 0)
+  return {
+    'pixels_per_frame': report['pixels'],
+    'pixels_per_s': report['pixels'] * len(times) / sum(times),
+    'bytes_per_frame': frame_bytes / len(times),
+    'latency_ms': {p: percentile(times, float(p[1:])) * 1e3 for p in ('p50', 'p90', 'p99', 'p100')},
+  }
+
+
+def version():
+  # commit benchmarked, if in git
+  try:
+    return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or 'unknown'
+  except OSError:
+    return 'unknown'
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description='Measure how fast the ansi and ncurses renderers draw, without a terminal.')
+  parser.add_argument('cases', nargs='*', default=list(CASES), help='cases to run, of ' + ', '.join(CASES))
+  parser.add_argument('--sink', choices=('pty', 'null'), default='pty', help='draw into a pseudo-terminal or a pipe')
+  parser.add_argument('--size', default='120x40', help='terminal columns x lines')
+  parser.add_argument('--frames', type=int, default=50)
+  parser.add_argument('--output', help='JSON file to save results to, by default bench/results/render-<version>.json')
+  parser.add_argument('--compare', help='JSON results to compare with')
+  parser.add_argument('--child', help=argparse.SUPPRESS)
+  parser.add_argument('--result-fd', type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  width, height = (int(n) for n in args.size.split('x'))
+
+  if args.child:
+    child(args.child, width, height, args.frames, args.result_fd)
+    sys.exit(0)
+
+  results = {
+    'version': version(),
+    'python': platform.python_version(),
+    'sink': args.sink,
+    'size': [width, height],
+    'frames': args.frames,
+    'cases': {},
+  }
+  old = None
+  if args.compare:
+    with open(args.compare) as f:
+      old = json.load(f)['cases']
+
+  print('%-18s %14s %14s %9s %9s %9s' % ('case', 'pixels/s', 'bytes/frame', 'p50 ms', 'p99 ms', 'max ms'))
+  for case in args.cases:
+    result = run(case, args.sink, width, height, args.frames)
+    results['cases'][case] = result
+    latency = result['latency_ms']
+    line = '%-18s %14.0f %14.0f %9.2f %9.2f %9.2f' % (case, result['pixels_per_s'], result['bytes_per_frame'], latency['p50'], latency['p99'], latency['p100'])
+    if old is not None and case in old:
+      line += '  %+.0f%%' % (100 * (result['pixels_per_s'] / old[case]['pixels_per_s'] - 1))
+    print(line)
+
+  output = args.output
+  if output is None:
+    os.makedirs(RESULTS, exist_ok=True)
+    output = os.path.join(RESULTS, 'render-' + results['version'] + '.json')
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=2)
+  print('saved', output)
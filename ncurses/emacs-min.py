@@ -4,7 +4,1463 @@ import curses
 from curses import wrapper, window, A_REVERSE, A_NORMAL
 from curses.textpad import Textbox
 
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from functools import wraps
 from time import sleep
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+
+class GapBuffer():
+    """Sequence with a movable gap, so edits next to the last edit are cheap"""
+
+    def __init__(self, items=(), gap_size=64):
+        """Initialize the buffer with the items and an empty gap after them"""
+        self.items = list(items)
+        self.gap_start = len(self.items)
+        self.items.extend([None] * gap_size)
+        self.gap_end = len(self.items)
+
+    def __len__(self):
+        return len(self.items) - (self.gap_end - self.gap_start)
+
+    def __iter__(self):
+        for i in range(0, self.gap_start):
+            yield self.items[i]
+        for i in range(self.gap_end, len(self.items)):
+            yield self.items[i]
+
+    def _index(self, pos):
+        """Map a position in the sequence to an index in items"""
+        if pos < 0:
+            pos += len(self)
+        if pos < 0 or pos >= len(self):
+            raise IndexError('GapBuffer index out of range')
+        if pos < self.gap_start:
+            return pos
+        return pos + self.gap_end - self.gap_start
+
+    def __getitem__(self, pos):
+        return self.items[self._index(pos)]
+
+    def __setitem__(self, pos, item):
+        self.items[self._index(pos)] = item
+
+    def _move_gap(self, pos):
+        """Move the gap so it starts at pos, costs the distance moved"""
+        if pos < self.gap_start:
+            n = self.gap_start - pos
+            self.items[self.gap_end-n:self.gap_end] = self.items[pos:self.gap_start]
+            self.gap_start -= n
+            self.gap_end -= n
+        elif pos > self.gap_start:
+            n = pos - self.gap_start
+            self.items[self.gap_start:pos] = self.items[self.gap_end:self.gap_end+n]
+            self.gap_start += n
+            self.gap_end += n
+        # return nothing
+        return
+
+    def insert(self, pos, items):
+        """Insert a sequence of items before pos"""
+        n = len(items)
+        self._move_gap(pos)
+        if self.gap_end - self.gap_start < n:
+            # grow the gap geometrically so inserts stay amortized O(1)
+            grow = max(n, len(self.items))
+            self.items[self.gap_end:self.gap_end] = [None] * grow
+            self.gap_end += grow
+        self.items[self.gap_start:self.gap_start+n] = items
+        self.gap_start += n
+        # return nothing
+        return
+
+    def delete(self, pos, count=1):
+        """Delete count items starting at pos, returning them as a list"""
+        count = max(0, min(count, len(self) - pos))
+        self._move_gap(pos)
+        removed = self.items[self.gap_end:self.gap_end+count]
+        self.items[self.gap_end:self.gap_end+count] = [None] * count
+        self.gap_end += count
+        return removed
+
+    def slice(self, start, stop):
+        """Return the items from start up to stop as a list"""
+        start = max(0, start)
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+        shift = self.gap_end - self.gap_start
+        if stop <= self.gap_start:
+            return self.items[start:stop]
+        if start >= self.gap_start:
+            return self.items[start+shift:stop+shift]
+        return self.items[start:self.gap_start] + self.items[self.gap_end:stop+shift]
+
+
+def locked(method):
+    """Run a TextBuffer method holding the buffer's lock"""
+    @wraps(method)
+    def run_locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return run_locked
+
+
+class TextBuffer():
+    """Line storage behind a ScrollTextbox
+
+    Lines live in chunks of a few hundred lines each, with the first line
+    number of every chunk kept for bisecting, so inserting or deleting a
+    line only shifts one small chunk.  A chunk can also be a MappedRun of
+    file lines that are decoded on demand, and is split when edited.  The
+    line being edited is moved into a GapBuffer of characters, so typing
+    does not rebuild the line string.  Lines past the end of the buffer
+    read as blank lines.
+
+    Background threads may read lines while holding the lock, and every
+    edit is reported to the listeners as (kind, line number), kind being
+    'change', 'insert', 'delete' or 'reset'.  Edits are also recorded
+    with the text they removed and inserted in the journal, if one is set.
+    """
+
+    CHUNK_LINES = 512
+
+    def __init__(self, lines=("",)):
+        """Initialize the buffer with lines of text"""
+        self.lock = threading.RLock()
+        self.listeners = []
+        # UndoJournal recording the edits, None for none
+        self.journal = None
+        # MappedFile the lines were loaded from, None for none
+        self.source = None
+        self.replace(lines)
+
+    def _notify(self, kind, line_num):
+        """Tell the listeners about an edit"""
+        for listener in self.listeners:
+            listener(kind, line_num)
+        # return nothing
+        return
+
+    def _record(self, kind, line_num, col, removed, inserted):
+        """Record an edit in the journal"""
+        if self.journal is not None:
+            self.journal.record(kind, line_num, col, removed, inserted)
+        # return nothing
+        return
+
+    @locked
+    def replace(self, lines):
+        """Replace all of the text with lines, closing the file mapped"""
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        self.chunks = []
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == self.CHUNK_LINES:
+                self.chunks.append(chunk)
+                chunk = []
+        if len(chunk) > 0 or len(self.chunks) == 0:
+            self.chunks.append(chunk)
+        self.count = sum(len(chunk) for chunk in self.chunks)
+        self.starts = [0] * len(self.chunks)
+        self.stale_from = 0
+        self.last_chunk = 0
+        # line held in the gap buffer (None for no line)
+        self.active = None
+        self.active_gap = None
+        # mapped file still being indexed into the last chunk
+        self.tail = None
+        # line ending lines are saved with
+        self.newline = b'\n'
+        self._notify('reset', 0)
+        # return nothing
+        return
+
+    @locked
+    def load(self, source):
+        """Replace all of the text with the lines of a MappedFile"""
+        self.replace(())
+        self.source = source
+        self.chunks = [MappedRun(source, 0, 0)]
+        self.tail = source
+        self.newline = source.newline
+        self._sync()
+        self._notify('reset', 0)
+        # return nothing
+        return
+
+    def close(self):
+        """Let go of the text and of the file it was mapped from"""
+        self.replace(())
+        # return nothing
+        return
+
+    def _sync(self):
+        """Take in lines indexed by the background scan of a mapped file"""
+        if self.tail is not None:
+            done = self.tail.done.is_set()
+            stop = self.tail.line_count()
+            run = self.chunks[-1]
+            if stop > run.stop:
+                self.count += stop - run.stop
+                run.stop = stop
+            if done:
+                self.tail = None
+        # return nothing
+        return
+
+    @locked
+    def __len__(self):
+        self._sync()
+        return self.count
+
+    def __getitem__(self, line_num):
+        return self.line(line_num)
+
+    def __iter__(self):
+        return self.lines()
+
+    def _fix_starts(self):
+        """Recompute chunk start line numbers made stale by edits"""
+        i = self.stale_from
+        if i > 0:
+            n = self.starts[i-1] + len(self.chunks[i-1])
+        else:
+            n = 0
+        for j in range(i, len(self.chunks)):
+            self.starts[j] = n
+            n += len(self.chunks[j])
+        self.stale_from = len(self.chunks)
+        # return nothing
+        return
+
+    def _locate(self, line_num):
+        """Return (chunk index, offset in chunk) of an existing line"""
+        ci = self.last_chunk
+        # the chunk used last is usually the one being edited
+        if ci < self.stale_from and ci < len(self.chunks):
+            offset = line_num - self.starts[ci]
+            if 0 <= offset < len(self.chunks[ci]):
+                return ci, offset
+        self._fix_starts()
+        ci = bisect_right(self.starts, line_num) - 1
+        self.last_chunk = ci
+        return ci, line_num - self.starts[ci]
+
+    def _changed(self, ci):
+        """Mark chunk starts after chunk ci as stale"""
+        self.stale_from = min(self.stale_from, ci + 1)
+        # return nothing
+        return
+
+    def _writable(self, ci, offset):
+        """Split a mapped run so the line at offset sits in a list chunk"""
+        run = self.chunks[ci]
+        if isinstance(run, list):
+            return ci, offset
+        pieces = []
+        if offset > 0:
+            pieces.append(MappedRun(run.source, run.start, run.start + offset))
+        pieces.append([run[offset]])
+        rest = MappedRun(run.source, run.start + offset + 1, run.stop)
+        # the last run keeps growing while its file is indexed
+        if len(rest) > 0 or (self.tail is not None and ci == len(self.chunks) - 1):
+            pieces.append(rest)
+        self.chunks[ci:ci+1] = pieces
+        self.starts[ci+1:ci+1] = [0] * (len(pieces) - 1)
+        self._changed(ci)
+        if offset > 0:
+            return ci + 1, 0
+        return ci, 0
+
+    def _flush(self):
+        """Write the line held in the gap buffer back into its chunk"""
+        if self.active is not None:
+            ci, offset = self._locate(self.active)
+            self.chunks[ci][offset] = ''.join(self.active_gap)
+            self.active = None
+            self.active_gap = None
+        # return nothing
+        return
+
+    def _activate(self, line_num):
+        """Move a line into the gap buffer for character editing"""
+        self.ensure(line_num)
+        if self.active != line_num:
+            self._flush()
+            ci, offset = self._writable(*self._locate(line_num))
+            self.active_gap = GapBuffer(self.chunks[ci][offset])
+            self.active = line_num
+        return self.active_gap
+
+    @locked
+    def line(self, line_num):
+        """Return the text of a line"""
+        if line_num == self.active:
+            return ''.join(self.active_gap)
+        self._sync()
+        if line_num < 0 or line_num >= self.count:
+            return ""
+        ci, offset = self._locate(line_num)
+        return self.chunks[ci][offset]
+
+    @locked
+    def line_len(self, line_num):
+        """Return the length of a line"""
+        if line_num == self.active:
+            return len(self.active_gap)
+        self._sync()
+        if line_num < 0 or line_num >= self.count:
+            return 0
+        ci, offset = self._locate(line_num)
+        chunk = self.chunks[ci]
+        if isinstance(chunk, list):
+            return len(chunk[offset])
+        # long mapped lines are measured without decoding them whole
+        return chunk.line_len(offset)
+
+    @locked
+    def line_slice(self, line_num, start, stop):
+        """Return the text of a line from column start up to column stop"""
+        if line_num == self.active:
+            return ''.join(self.active_gap.slice(start, stop))
+        self._sync()
+        if line_num < 0 or line_num >= self.count:
+            return ""
+        ci, offset = self._locate(line_num)
+        chunk = self.chunks[ci]
+        if isinstance(chunk, list):
+            return chunk[offset][max(0, start):max(0, stop)]
+        return chunk.line_slice(offset, start, stop)
+
+    def lines(self, start=0, stop=None):
+        """Iterate over the text of lines from start up to stop"""
+        self._sync()
+        if stop is None or stop > self.count:
+            stop = self.count
+        if start >= stop:
+            return
+        ci, offset = self._locate(start)
+        line_num = start
+        while line_num < stop:
+            chunk = self.chunks[ci]
+            for i in range(offset, min(len(chunk), offset + stop - line_num)):
+                if line_num == self.active:
+                    yield ''.join(self.active_gap)
+                else:
+                    yield chunk[i]
+                line_num += 1
+            ci += 1
+            offset = 0
+
+    @locked
+    def search_lines(self, regex, bregex, start, budget=1 << 20):
+        """Return (lines matching from start, line to go on from), scanning about budget characters
+
+        Mapped lines are searched as bytes with bregex, a literal pattern,
+        or decoded a line at a time like edited lines when bregex is None.
+        """
+        self._sync()
+        found = []
+        line_num = start
+        while line_num < self.count and budget > 0:
+            ci, offset = self._locate(line_num)
+            chunk = self.chunks[ci]
+            if isinstance(chunk, list) or bregex is None:
+                for i in range(offset, len(chunk)):
+                    if budget <= 0:
+                        break
+                    line = chunk[i] if line_num != self.active else self.line(line_num)
+                    if regex.search(line):
+                        found.append(line_num)
+                    budget -= len(line) + 1
+                    line_num += 1
+            else:
+                # mapped lines are searched as bytes, numbered from the chunk start
+                first = line_num - offset - chunk.start
+                lines, stop, searched = chunk.source.search_lines(bregex, chunk.start + offset, chunk.stop, budget)
+                found.extend(first + n for n in lines)
+                budget -= searched
+                line_num = first + stop
+        return found, line_num
+
+    @locked
+    def ensure(self, line_num):
+        """Append blank lines until line_num exists"""
+        self._sync()
+        if self.tail is not None and line_num >= self.count:
+            # lines past the end must go after the whole file
+            self.tail.wait()
+            self._sync()
+        while self.count <= line_num:
+            self.insert_line(self.count)
+        # return nothing
+        return
+
+    @locked
+    def insert_line(self, line_num, text=""):
+        """Insert a line before line_num, or append at the end"""
+        self._sync()
+        if line_num >= self.count:
+            if self.tail is not None:
+                # lines past the end must go after the whole file
+                self.tail.wait()
+                self._sync()
+            line_num = self.count
+            if not isinstance(self.chunks[-1], list):
+                self.chunks.append([])
+                self.starts.append(0)
+            ci = len(self.chunks) - 1
+            offset = len(self.chunks[ci])
+        else:
+            ci, offset = self._writable(*self._locate(line_num))
+        chunk = self.chunks[ci]
+        chunk.insert(offset, text)
+        self.count += 1
+        if self.active is not None and self.active >= line_num:
+            self.active += 1
+        self._record('insert', line_num, 0, "", text)
+        self._notify('insert', line_num)
+        # split chunks that grew too long, keeping each insert cheap
+        if len(chunk) > 2 * self.CHUNK_LINES:
+            half = len(chunk) // 2
+            self.chunks.insert(ci + 1, chunk[half:])
+            del chunk[half:]
+            self.starts.insert(ci + 1, 0)
+            if self.stale_from > ci:
+                self.stale_from += 1
+        self._changed(ci)
+        # return nothing
+        return
+
+    @locked
+    def delete_line(self, line_num):
+        """Delete a line, returning its text"""
+        if line_num < 0 or line_num >= self.count:
+            return ""
+        text = self.line(line_num)
+        ci, offset = self._writable(*self._locate(line_num))
+        chunk = self.chunks[ci]
+        del chunk[offset]
+        self.count -= 1
+        if self.active == line_num:
+            self.active = None
+            self.active_gap = None
+        elif self.active is not None and self.active > line_num:
+            self.active -= 1
+        # drop emptied chunks, but always keep one
+        if len(chunk) == 0 and len(self.chunks) > 1:
+            del self.chunks[ci]
+            del self.starts[ci]
+            self.stale_from = min(self.stale_from, ci)
+            self.last_chunk = 0
+        self._changed(ci)
+        self._record('delete', line_num, 0, text, "")
+        self._notify('delete', line_num)
+        return text
+
+    @locked
+    def set_line(self, line_num, text):
+        """Replace the text of a line"""
+        self.ensure(line_num)
+        old = self.line(line_num)
+        if self.active == line_num:
+            self.active = None
+            self.active_gap = None
+        ci, offset = self._writable(*self._locate(line_num))
+        self.chunks[ci][offset] = text
+        self._record('change', line_num, 0, old, text)
+        self._notify('change', line_num)
+        # return nothing
+        return
+
+    def append(self, text):
+        """Add a line at the end"""
+        self.insert_line(self.count, text)
+        # return nothing
+        return
+
+    @locked
+    def save(self, filename):
+        """Write the text to a file, replacing the file atomically
+
+        Lines are streamed out a chunk at a time into a temporary file that
+        is renamed over the file once synced.  Mapped runs have not changed
+        since the file was opened, so they are copied as they are and only
+        edited chunks are encoded, with the line ending of the file opened.
+        The file saved is then mapped in place of the file opened, which is
+        closed.
+        """
+        if self.tail is not None:
+            self.tail.wait()
+        self._sync()
+        self._flush()
+        path = os.path.realpath(filename)
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        fd, temp_name = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in self.chunks:
+                    if isinstance(chunk, list):
+                        file.writelines(line.encode('utf-8', 'surrogateescape') + self.newline for line in chunk)
+                    else:
+                        chunk.source.copy_lines(chunk.start, chunk.stop, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(temp_name, mode)
+            os.replace(temp_name, path)
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+        # sync the directory so the rename itself is on disk
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+        if self.source is not None:
+            # the saved lines are those of the buffer, so the old file can
+            # go, unless the new one cannot be mapped
+            try:
+                source = MappedFile(path)
+            except OSError:
+                return
+            source.wait()
+            if source.line_count() != self.count:
+                # changed meanwhile by someone else
+                source.close()
+                return
+            self.source.close()
+            self.source = source
+            self.chunks = [MappedRun(source, 0, source.line_count())]
+            self.starts = [0]
+            self.stale_from = 0
+            self.last_chunk = 0
+        # return nothing
+        return
+
+    @locked
+    def set_char(self, line_num, col, ch):
+        """Overwrite the character at col, padding the line with spaces"""
+        gap = self._activate(line_num)
+        start = min(col, len(gap))
+        pad = ' ' * (col - start)
+        if pad:
+            gap.insert(start, pad)
+        if col < len(gap):
+            removed = gap[col]
+            gap[col] = ch
+        else:
+            removed = ""
+            gap.insert(col, ch)
+        self._record('change', line_num, start, removed, pad + ch)
+        self._notify('change', line_num)
+        # return nothing
+        return
+
+    @locked
+    def set_chars(self, line_num, col, text):
+        """Overwrite characters from col on with text, padding with spaces"""
+        gap = self._activate(line_num)
+        start = min(col, len(gap))
+        pad = ' ' * (col - start)
+        if pad:
+            gap.insert(start, pad)
+        removed = ''.join(gap.delete(col, len(text)))
+        gap.insert(col, text)
+        self._record('change', line_num, start, removed, pad + text)
+        self._notify('change', line_num)
+        # return nothing
+        return
+
+    @locked
+    def splice(self, line_num, col, count, text):
+        """Replace count characters from col on with text"""
+        gap = self._activate(line_num)
+        removed = ''.join(gap.delete(col, count))
+        gap.insert(col, text)
+        self._record('change', line_num, col, removed, text)
+        self._notify('change', line_num)
+        # return nothing
+        return
+
+    @locked
+    def delete_char(self, line_num, col):
+        """Delete the character at col, returning it"""
+        if col < 0 or col >= self.line_len(line_num):
+            return ""
+        gap = self._activate(line_num)
+        ch = ''.join(gap.delete(col))
+        self._record('change', line_num, col, ch, "")
+        self._notify('change', line_num)
+        return ch
+
+
+class MappedFile():
+    """Lines of a memory-mapped file, only decoded when asked for
+
+    A background thread counts newlines a block at a time, keeping the
+    number of newlines before each block, so finding a line only scans
+    within one block and memory stays proportional to the file size over
+    the block size.  Lines read in order reuse the last position found.
+
+    Long lines get a column index the first time they are sliced, with
+    the column at every COLUMN_STEP bytes or so, so showing part of a line
+    megabytes long only decodes the bytes around that part.
+    """
+
+    BLOCK_SIZE = 1 << 14
+    # lines longer than this many bytes are sliced through a column index
+    LONG_LINE = 1 << 16
+    COLUMN_STEP = 1 << 12
+    # column indexes kept, for the long lines shown most recently
+    COLUMN_INDEXES = 64
+
+    def __init__(self, filename):
+        """Map the file and start indexing its lines"""
+        # file stays open for copying unchanged lines when saving
+        self.file = open(filename, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+        self.filename = filename
+        # line ending of the file, taken from its first line
+        first = self.data.find(b'\n', 0, self.LONG_LINE)
+        self.newline = b'\r\n' if first > 0 and self.data[first-1:first] == b'\r' else b'\n'
+        # newlines before the start of each block
+        self.block_newlines = array('Q')
+        self.newlines = 0
+        # (line number, start offset) of the last line found
+        self.last_line = (0, 0)
+        # line number to (start offset, end offset, length, columns, offsets)
+        self.column_indexes = {}
+        self.done = threading.Event()
+        self.closed = False
+        self.scanner = threading.Thread(target=self._scan, daemon=True)
+        self.scanner.start()
+
+    def close(self):
+        """Stop indexing, unmap the file and close it"""
+        self.closed = True
+        self.scanner.join()
+        if self.size > 0:
+            self.data.close()
+        self.file.close()
+        # return nothing
+        return
+
+    def _scan(self):
+        """Count the newlines in every block of the file"""
+        newlines = 0
+        for start in range(0, self.size, self.BLOCK_SIZE):
+            if self.closed:
+                break
+            self.block_newlines.append(newlines)
+            newlines += self.data[start:start+self.BLOCK_SIZE].count(b'\n')
+            self.newlines = newlines
+        self.done.set()
+        # return nothing
+        return
+
+    def line_count(self):
+        """Return the number of lines indexed so far"""
+        if self.done.is_set() and self.size > 0 and self.data[-1:] != b'\n':
+            # last line has no newline
+            return self.newlines + 1
+        return self.newlines
+
+    def wait(self, lines=None):
+        """Wait for the file to be indexed, or at least lines lines of it"""
+        if lines is None:
+            self.done.wait()
+        while not self.done.is_set() and self.newlines < lines:
+            self.done.wait(0.001)
+        # return nothing
+        return
+
+    def line_start(self, line_num):
+        """Return the offset of the first byte of a line"""
+        if line_num == 0:
+            return 0
+        last_num, pos = self.last_line
+        if last_num > line_num or line_num - last_num > 64:
+            # the line begins after newline number line_num, find its block
+            block = bisect_left(self.block_newlines, line_num) - 1
+            last_num = self.block_newlines[block] + 1
+            pos = self.data.find(b'\n', block * self.BLOCK_SIZE) + 1
+        while last_num < line_num:
+            pos = self.data.find(b'\n', pos) + 1
+            last_num += 1
+        self.last_line = (line_num, pos)
+        return pos
+
+    def line_range(self, line_num):
+        """Return the offsets of the first byte of a line and of its line ending"""
+        start = self.line_start(line_num)
+        end = self.data.find(b'\n', start)
+        if end < 0:
+            end = self.size
+        if end > start and self.data[end-1:end] == b'\r':
+            end -= 1
+        return start, end
+
+    def line_bytes(self, line_num):
+        """Return the raw bytes of a line, without its line ending"""
+        start, end = self.line_range(line_num)
+        return self.data[start:end]
+
+    def line(self, line_num):
+        """Return the text of a line"""
+        return self.line_bytes(line_num).decode('utf-8', 'surrogateescape')
+
+    def _column_index(self, line_num):
+        """Return the column index of a long line, None for a short line"""
+        index = self.column_indexes.pop(line_num, None)
+        if index is None:
+            start, end = self.line_range(line_num)
+            if end - start <= self.LONG_LINE:
+                return None
+            columns = array('Q')
+            offsets = array('Q')
+            col = 0
+            pos = start
+            while pos < end:
+                columns.append(col)
+                offsets.append(pos)
+                stop = min(end, pos + self.COLUMN_STEP)
+                # end the step on the first byte of a character
+                for _ in range(0, 3):
+                    if stop == end or self.data[stop] & 0xc0 != 0x80:
+                        break
+                    stop += 1
+                col += len(self.data[pos:stop].decode('utf-8', 'surrogateescape'))
+                pos = stop
+            index = (start, end, col, columns, offsets)
+            if len(self.column_indexes) >= self.COLUMN_INDEXES:
+                del self.column_indexes[next(iter(self.column_indexes))]
+        # most recently used last
+        self.column_indexes[line_num] = index
+        return index
+
+    def line_len(self, line_num):
+        """Return the length of a line"""
+        index = self._column_index(line_num)
+        if index is None:
+            return len(self.line(line_num))
+        return index[2]
+
+    def line_slice(self, line_num, start, stop):
+        """Return the text of a line from column start up to column stop"""
+        start = max(0, start)
+        stop = max(0, stop)
+        index = self._column_index(line_num)
+        if index is None:
+            return self.line(line_num)[start:stop]
+        begin, end, length, columns, offsets = index
+        stop = min(stop, length)
+        if start >= stop:
+            return ""
+        # decode from the step the slice starts in, a character is at most 4 bytes
+        i = bisect_right(columns, start) - 1
+        pos = offsets[i]
+        text = self.data[pos:min(end, pos + 4 * (stop - columns[i]))].decode('utf-8', 'surrogateescape')
+        return text[start - columns[i]:stop - columns[i]]
+
+    def search_lines(self, bregex, start, stop, budget):
+        """Return (lines from start up to stop matching bregex, line to go on from, bytes searched)
+
+        Searches about budget bytes, ending at a line end.  bregex must be
+        a literal pattern without a newline, so a match never spans lines
+        and matches the same lines as it would decoded.
+        """
+        begin = self.line_start(start)
+        if stop < self.line_count():
+            end = self.line_start(stop)
+        else:
+            end = self.size
+        if end - begin > budget:
+            newline = self.data.find(b'\n', begin + budget, end)
+            if newline >= 0:
+                end = newline + 1
+                stop = None
+        window = self.data[begin:end]
+        found = []
+        line_num = start
+        pos = 0
+        while True:
+            match = bregex.search(window, pos)
+            if match is None:
+                break
+            line_num += window.count(b'\n', pos, match.start())
+            found.append(line_num)
+            # go on from the next line
+            pos = window.find(b'\n', match.start()) + 1
+            if pos == 0:
+                break
+            line_num += 1
+        if stop is None:
+            stop = start + window.count(b'\n')
+        return found, stop, len(window)
+
+    def copy_lines(self, start, stop, out):
+        """Write lines start up to stop, as they are in the file, to out"""
+        if start >= stop:
+            return
+        begin = self.line_start(start)
+        if stop < self.line_count():
+            end = self.line_start(stop)
+        else:
+            end = self.size
+        # copy in the kernel if possible, without reading into memory
+        out.flush()
+        try:
+            while begin < end:
+                copied = os.copy_file_range(self.file.fileno(), out.fileno(), end - begin, begin)
+                if copied == 0:
+                    break
+                begin += copied
+        except (AttributeError, OSError):
+            pass
+        while begin < end:
+            out.write(self.data[begin:min(end, begin + (1 << 20))])
+            begin += 1 << 20
+        # every saved line ends with a line ending
+        if end == self.size and self.data[-1:] != b'\n':
+            out.write(self.newline)
+        # return nothing
+        return
+
+
+class MappedRun():
+    """Lines start up to stop of a MappedFile, used as a TextBuffer chunk"""
+
+    def __init__(self, source, start, stop):
+        self.source = source
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, offset):
+        return self.source.line(self.start + offset)
+
+    def line_len(self, offset):
+        return self.source.line_len(self.start + offset)
+
+    def line_slice(self, offset, start, stop):
+        return self.source.line_slice(self.start + offset, start, stop)
+
+
+class PageIndex(dict):
+    """Horizontal page number of each line, only pages past 1 are stored"""
+
+    def __missing__(self, line_num):
+        return 1
+
+    def __setitem__(self, line_num, page):
+        if page == 1:
+            self.pop(line_num, None)
+        else:
+            dict.__setitem__(self, line_num, page)
+
+    def shift(self, line_num, delta):
+        """Move page numbers of lines from line_num on by delta lines"""
+        moved = [(n, page) for n, page in self.items() if n >= line_num]
+        for n, page in moved:
+            del self[n]
+        for n, page in moved:
+            if n + delta >= line_num:
+                self[n + delta] = page
+        # return nothing
+        return
+
+
+# lexer states carried from the end of one line to the next
+NORMAL, BLOCK_COMMENT, TRIPLE_DOUBLE, TRIPLE_SINGLE = range(4)
+TOKENS = re.compile(r"""(?P<comment>\#.*|//.*)|(?P<block>/\*)"""
+                    r"""|(?P<triple>\"\"\"|''')"""
+                    r"""|(?P<string>"(?:\\.|[^"\\])*"?|'(?:\\.|[^'\\])*'?)"""
+                    r"""|(?P<number>\b\d[\d_]*(?:\.\d+)?\b)|(?P<word>\b[A-Za-z_]\w*\b)""")
+KEYWORDS = frozenset("""and as assert async await break case catch class const
+continue def del do elif else enum except export extern False finally for from
+function global if import in is lambda let new nil None nonlocal not null or
+pass raise return self static struct switch this throw True try typedef var
+void while with yield""".split())
+
+
+class Highlighter():
+    """Syntax highlighting of a TextBuffer, lexed in a background thread
+
+    Only the lines shown are lexed, from the lexer state at the start of
+    the nearest line before them that is a multiple of CHECKPOINT_LINES.
+    Those states are all that is kept for the whole buffer, filled in from
+    the start as lines are lexed.  When the lines shown are further than
+    MAX_DISTANCE lines past the last one, they are lexed from the normal
+    state instead, so jumping into a huge file does not lex all of it.
+
+    Lexed lines keep (state at start, spans, state at end) in a cache of
+    the CACHE_LINES used last.  Edits forget the edited lines, and lines
+    whose start state is unchanged are not lexed again, so re-lexing
+    stops once the state converges.
+    """
+
+    BATCH_LINES = 64
+    CHECKPOINT_LINES = 256
+    MAX_DISTANCE = 1024
+    CACHE_LINES = 4096
+
+    def __init__(self, text):
+        """Start highlighting text"""
+        self.text = text
+        self.lock = threading.Lock()
+        # line number -> (state at start, spans, state at end), used last last
+        self.cache = OrderedDict()
+        # state at the start of every CHECKPOINT_LINES-th line, from line 0
+        self.checkpoints = array('B', [NORMAL])
+        # lines shown, top and one past the bottom
+        self.top = 0
+        self.bottom = 0
+        # edits seen, results lexed before an edit are dropped
+        self.edits = 0
+        # lines with new spans since the last draw
+        self.updated = set()
+        self.attrs = {}
+        if curses.has_colors():
+            for pair, (kind, color) in enumerate((('comment', curses.COLOR_BLUE), ('string', curses.COLOR_GREEN),
+                                                  ('number', curses.COLOR_MAGENTA), ('keyword', curses.COLOR_YELLOW)), 1):
+                curses.init_pair(pair, color, curses.COLOR_BLACK)
+                self.attrs[kind] = curses.color_pair(pair)
+        else:
+            self.attrs = {'comment': curses.A_DIM, 'string': curses.A_UNDERLINE, 'number': A_NORMAL, 'keyword': curses.A_BOLD}
+        self.attrs['keyword'] |= curses.A_BOLD
+        self.wake = threading.Event()
+        self.running = True
+        text.listeners.append(self.edited)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        self.running = False
+        self.text.listeners.remove(self.edited)
+        self.wake.set()
+        # return nothing
+        return
+
+    def edited(self, kind, line_num):
+        """Forget lexed lines changed by an edit"""
+        with self.lock:
+            self.edits += 1
+            if kind == 'reset':
+                self.cache = OrderedDict()
+                line_num = 0
+            elif kind == 'change':
+                self.cache.pop(line_num, None)
+            else:
+                # lines after the edit move, keeping the order they were used in
+                delta = 1 if kind == 'insert' else -1
+                self.cache = OrderedDict((n + delta if n >= line_num else n, entry)
+                                         for n, entry in self.cache.items() if n != line_num or kind == 'insert')
+            # states at lines up to the edited one are still right
+            del self.checkpoints[line_num // self.CHECKPOINT_LINES + 1:]
+        self.wake.set()
+        # return nothing
+        return
+
+    def show(self, top_line_num, rows):
+        """Lex the lines on the screen"""
+        self.top = top_line_num
+        self.bottom = top_line_num + rows
+        self.wake.set()
+        # return nothing
+        return
+
+    def spans(self, line_num):
+        """Return (start, end, attr) spans of a line, or () if not lexed yet"""
+        with self.lock:
+            entry = self.cache.get(line_num)
+            if entry is not None:
+                self.cache.move_to_end(line_num)
+                return entry[1]
+        return ()
+
+    def take_updated(self):
+        """Return and forget the lines given new spans"""
+        with self.lock:
+            updated = self.updated
+            self.updated = set()
+        return updated
+
+    def lex(self, line, state):
+        """Return (spans, end state) of a line lexed from state"""
+        spans = []
+        pos = 0
+        # finish a comment or string left open by the line before
+        if state != NORMAL:
+            end_mark = {BLOCK_COMMENT: '*/', TRIPLE_DOUBLE: '"""', TRIPLE_SINGLE: "'''"}[state]
+            kind = 'comment' if state == BLOCK_COMMENT else 'string'
+            end = line.find(end_mark)
+            if end < 0:
+                return ((0, len(line), self.attrs[kind]),), state
+            pos = end + len(end_mark)
+            spans.append((0, pos, self.attrs[kind]))
+            state = NORMAL
+        while True:
+            match = TOKENS.search(line, pos)
+            if match is None:
+                break
+            kind = match.lastgroup
+            start, pos = match.span()
+            if kind == 'block' or kind == 'triple':
+                end_mark = '*/' if kind == 'block' else match.group()
+                end = line.find(end_mark, pos)
+                attr = self.attrs['comment' if kind == 'block' else 'string']
+                if end < 0:
+                    spans.append((start, len(line), attr))
+                    if kind == 'block':
+                        state = BLOCK_COMMENT
+                    elif end_mark == '"""':
+                        state = TRIPLE_DOUBLE
+                    else:
+                        state = TRIPLE_SINGLE
+                    break
+                pos = end + len(end_mark)
+                spans.append((start, pos, attr))
+            elif kind == 'word':
+                if match.group() in KEYWORDS:
+                    spans.append((start, pos, self.attrs['keyword']))
+            else:
+                spans.append((start, pos, self.attrs[kind]))
+        return tuple(spans), state
+
+    def _next_line(self, top, bottom):
+        """Return (line, state at its start, whether the state is known) of
+        the first line to lex for lines top up to bottom, None if all are lexed"""
+        checkpoint = min(top // self.CHECKPOINT_LINES, len(self.checkpoints) - 1)
+        line_num = checkpoint * self.CHECKPOINT_LINES
+        state = self.checkpoints[checkpoint]
+        known = True
+        if top - line_num > self.MAX_DISTANCE:
+            # too far to lex up to, guess the lines start in the normal state
+            line_num = top
+            state = NORMAL
+            known = False
+        # skip lines lexed from the same start state, filling in checkpoints
+        while line_num < bottom:
+            if known and line_num == len(self.checkpoints) * self.CHECKPOINT_LINES:
+                self.checkpoints.append(state)
+            entry = self.cache.get(line_num)
+            if entry is None or entry[0] != state:
+                return line_num, state, known
+            state = entry[2]
+            line_num += 1
+        return None
+
+    def _run(self):
+        """Lex the lines shown that need lexing whenever woken"""
+        while self.running:
+            self.wake.wait()
+            self.wake.clear()
+            while self.running:
+                # read a batch of lines that need lexing
+                with self.text.lock, self.lock:
+                    bottom = min(self.bottom, len(self.text))
+                    first = self._next_line(self.top, bottom)
+                    if first is None:
+                        break
+                    start, state, known = first
+                    lines = [self.text.line(n) for n in range(start, min(bottom, start + self.BATCH_LINES))]
+                    old_entries = [self.cache.get(n) for n in range(start, start + len(lines))]
+                    edits = self.edits
+                # lex without holding the locks
+                entries = []
+                for line, old_entry in zip(lines, old_entries):
+                    # the rest is lexed already once the state converges
+                    if len(entries) > 0 and old_entry is not None and old_entry[0] == state:
+                        break
+                    spans, end_state = self.lex(line, state)
+                    entries.append((state, spans, end_state))
+                    state = end_state
+                with self.lock:
+                    if edits != self.edits:
+                        continue
+                    for n, entry in enumerate(entries, start):
+                        if known and n == len(self.checkpoints) * self.CHECKPOINT_LINES:
+                            self.checkpoints.append(entry[0])
+                        self.cache[n] = entry
+                        self.cache.move_to_end(n)
+                        self.updated.add(n)
+                    while len(self.cache) > self.CACHE_LINES:
+                        self.cache.popitem(last=False)
+        # return nothing
+        return
+
+
+class SearchIndex():
+    """Lines of a TextBuffer matching a pattern, found by a background scan
+
+    Matching line numbers are kept in a sorted list, so stepping to the
+    next or previous match is a bisect.  The scan takes the buffer a batch
+    at a time, and afterwards edits only re-test the edited line and shift
+    the line numbers after an inserted or deleted line.
+    """
+
+    def __init__(self, text, pattern, is_regex=False):
+        """Start scanning text for pattern (a regular expression if is_regex)"""
+        if not is_regex:
+            pattern = re.escape(pattern)
+        self.regex = re.compile(pattern)
+        # mapped lines are searched for literal patterns without decoding
+        # them, regexes are matched a line at a time as for edited lines
+        self.bregex = None
+        if not is_regex:
+            self.bregex = re.compile(pattern.encode('utf-8', 'surrogateescape'))
+        self.text = text
+        self.lock = threading.Lock()
+        self.lines = []
+        # lines before scanned_to have been searched
+        self.scanned_to = 0
+        self.running = True
+        self.done = threading.Event()
+        text.listeners.append(self.edited)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        """Stop scanning and following edits"""
+        self.running = False
+        if self.edited in self.text.listeners:
+            self.text.listeners.remove(self.edited)
+        # return nothing
+        return
+
+    def _run(self):
+        """Scan the buffer a batch of lines at a time"""
+        while self.running:
+            with self.text.lock:
+                start = self.scanned_to
+                found, next_line = self.text.search_lines(self.regex, self.bregex, start)
+                with self.lock:
+                    self.lines.extend(found)
+                    self.scanned_to = next_line
+                at_end = next_line >= len(self.text)
+                # a mapped file may still be getting indexed
+                indexing = self.text.tail is not None
+            if at_end and not indexing:
+                break
+            if next_line == start:
+                self.done.wait(0.01)
+        self.done.set()
+        # return nothing
+        return
+
+    def edited(self, kind, line_num):
+        """Keep the matches right after an edit"""
+        if kind == 'reset':
+            self.stop()
+            return
+        with self.lock:
+            if line_num >= self.scanned_to:
+                return
+            i = bisect_left(self.lines, line_num)
+            if kind == 'insert':
+                self.lines[i:] = [n + 1 for n in self.lines[i:]]
+                self.scanned_to += 1
+            elif kind == 'delete':
+                if i < len(self.lines) and self.lines[i] == line_num:
+                    del self.lines[i]
+                self.lines[i:] = [n - 1 for n in self.lines[i:]]
+                self.scanned_to -= 1
+                return
+            # re-test the changed or inserted line
+            matched = self.regex.search(self.text.line(line_num)) is not None
+            listed = i < len(self.lines) and self.lines[i] == line_num
+            if matched and not listed:
+                self.lines.insert(i, line_num)
+            elif listed and not matched:
+                del self.lines[i]
+        # return nothing
+        return
+
+    def since(self, count):
+        """Return matching lines after the first count found"""
+        with self.lock:
+            return self.lines[count:]
+
+    def find(self, line_num, forward=True):
+        """Return the next match after line_num (before going backward), wrapping around
+
+        Waits for the scan to get far enough, returns None without matches.
+        """
+        while True:
+            with self.lock:
+                done = self.done.is_set()
+                if forward:
+                    i = bisect_right(self.lines, line_num)
+                    if i < len(self.lines):
+                        return self.lines[i]
+                else:
+                    i = bisect_left(self.lines, line_num)
+                    if i > 0 and self.scanned_to >= line_num:
+                        return self.lines[i-1]
+                if done:
+                    if len(self.lines) == 0:
+                        return None
+                    return self.lines[0] if forward else self.lines[-1]
+            self.done.wait(0.01)
+
+    def column(self, line_num):
+        """Return the column of the first match on a line"""
+        match = self.regex.search(self.text.line(line_num))
+        return match.start() if match else 0
+
+
+class UndoJournal():
+    """Undo and redo log of the edits made to a TextBuffer
+
+    Each edit is kept as a record of the text it removed and inserted
+    rather than a copy of the buffer, and a run of typing or deleting next
+    to the last edit grows the last record.  Records share a group number
+    per batch of keys, so a paste undoes in one step.  Once the records
+    take more than limit bytes the oldest are dropped.
+    """
+
+    # default limit on the memory used by the records, in bytes
+    LIMIT = 8 << 20
+    # rough memory used by a record besides its text
+    RECORD_BYTES = 160
+
+    def __init__(self, text, limit=LIMIT):
+        """Start recording the edits made to text"""
+        self.text = text
+        self.limit = limit
+        # records of [group, kind, line number, column, removed, inserted]
+        self.undos = deque()
+        self.redos = []
+        self.size = 0
+        self.group = 0
+        # whether the next edit may grow the last record
+        self.can_merge = False
+        self.replaying = False
+        text.journal = self
+        text.listeners.append(self.edited)
+
+    def _record_size(self, record):
+        """Return the rough memory used by a record"""
+        return self.RECORD_BYTES + len(record[4]) + len(record[5])
+
+    def clear(self):
+        """Drop every record"""
+        self.undos.clear()
+        self.redos = []
+        self.size = 0
+        self.can_merge = False
+        # return nothing
+        return
+
+    def edited(self, kind, line_num):
+        """Forget the records once the whole buffer is replaced"""
+        if kind == 'reset':
+            self.clear()
+        # return nothing
+        return
+
+    def new_group(self, merge=True):
+        """Start a new undo step, which may grow the last record if merge"""
+        self.group += 1
+        if not merge:
+            self.can_merge = False
+        # return nothing
+        return
+
+    def record(self, kind, line_num, col, removed, inserted):
+        """Record an edit of the text, growing the last record if it follows on"""
+        if self.replaying:
+            return
+        for record in self.redos:
+            self.size -= self._record_size(record)
+        self.redos = []
+        last = self.undos[-1] if self.can_merge and len(self.undos) > 0 else None
+        # only a record alone in its group is grown, so groups undo whole
+        if last is not None and len(self.undos) > 1 and self.undos[-2][0] == last[0]:
+            last = None
+        if last is not None and kind == last[1] == 'change' and line_num == last[2]:
+            if col == last[3] + len(last[5]):
+                # typing on from the end of the last edit
+                self.size += len(removed) + len(inserted)
+                last[0] = self.group
+                last[4] += removed
+                last[5] += inserted
+                self._evict()
+                return
+            if inserted == "" and col + len(removed) == last[3]:
+                # deleting backward from the start of the last edit
+                self.size += len(removed)
+                last[0] = self.group
+                last[3] = col
+                last[4] = removed + last[4]
+                self._evict()
+                return
+        record = [self.group, kind, line_num, col, removed, inserted]
+        self.undos.append(record)
+        self.size += self._record_size(record)
+        self.can_merge = kind == 'change'
+        self._evict()
+        # return nothing
+        return
+
+    def _evict(self):
+        """Drop the oldest records while over the limit"""
+        while self.size > self.limit and len(self.undos) > 1:
+            self.size -= self._record_size(self.undos.popleft())
+        # return nothing
+        return
+
+    def _apply(self, kind, line_num, col, removed, inserted):
+        """Make an edit, returning the (line number, column) it ends at"""
+        if kind == 'insert':
+            self.text.insert_line(line_num, inserted)
+            return (line_num, 0)
+        if kind == 'delete':
+            self.text.delete_line(line_num)
+            return (line_num, 0)
+        self.text.splice(line_num, col, len(removed), inserted)
+        return (line_num, col + len(inserted))
+
+    def undo(self):
+        """Undo the last group of edits, returning where, None if none"""
+        if len(self.undos) == 0:
+            return None
+        where = None
+        with self.text.lock:
+            self.replaying = True
+            try:
+                group = self.undos[-1][0]
+                while len(self.undos) > 0 and self.undos[-1][0] == group:
+                    record = self.undos.pop()
+                    kind = {'insert': 'delete', 'delete': 'insert'}.get(record[1], record[1])
+                    where = self._apply(kind, record[2], record[3], record[5], record[4])
+                    self.redos.append(record)
+            finally:
+                self.replaying = False
+        self.can_merge = False
+        return where
+
+    def redo(self):
+        """Redo the last group of undone edits, returning where, None if none"""
+        if len(self.redos) == 0:
+            return None
+        where = None
+        with self.text.lock:
+            self.replaying = True
+            try:
+                group = self.redos[-1][0]
+                while len(self.redos) > 0 and self.redos[-1][0] == group:
+                    record = self.redos.pop()
+                    where = self._apply(*record[1:])
+                    self.undos.append(record)
+            finally:
+                self.replaying = False
+        self.can_merge = False
+        return where
+
+
+class Damage():
+    """Text last drawn on each row of the text area, so unchanged rows are skipped"""
+
+    def __init__(self, rows):
+        """Initialize with every row unknown"""
+        self.rows = [None] * rows
+        self.forgotten = set(range(0, rows))
+
+    def changed(self, y, text):
+        """Return True if row y does not show text yet, and record that it will"""
+        self.forgotten.discard(y)
+        if self.rows[y] == text:
+            return False
+        self.rows[y] = text
+        return True
+
+    def touch(self, y):
+        """Forget row y after drawing on it directly"""
+        if 0 <= y < len(self.rows):
+            self.rows[y] = None
+            self.forgotten.add(y)
+        # return nothing
+        return
+
+    def invalidate(self):
+        """Forget every row, after scrolling or inserting lines"""
+        self.rows = [None] * len(self.rows)
+        self.forgotten = set(range(0, len(self.rows)))
+        # return nothing
+        return
+
+
+class StatusLine():
+    """Statusline made of named fields, redrawn only from the first change"""
+
+    def __init__(self, screen):
+        """Initialize with no fields"""
+        self.screen = screen
+        self.fields = {}
+        # (statusline string, screen width) last drawn
+        self.drawn = None
+
+    def set(self, name, text):
+        """Set a field, fields are shown in the order first set"""
+        self.fields[name] = text
+        # return nothing
+        return
+
+    def draw(self, message=""):
+        """Draw the fields, or message in their place, without refreshing"""
+        s_maxy, s_maxx = self.screen.getmaxyx()
+        # statuline string
+        if len(message) > 0:
+            statusline = '### ' + message + ' '
+        else:
+            statusline = '### ' + ' # '.join(self.fields.values()) + ' '
+        statusline = statusline[:s_maxx-1]
+        if self.drawn is None or self.drawn[1] != s_maxx:
+            start = 0
+            old_len = s_maxx
+        else:
+            start = len(os.path.commonprefix((statusline, self.drawn[0])))
+            old_len = len(self.drawn[0])
+        # redraw bottom hline (statusline) from the first changed character
+        if start < len(statusline):
+            self.screen.addstr(s_maxy-2, start, statusline[start:])
+        if len(statusline) < old_len:
+            self.screen.hline(s_maxy-2, len(statusline), '#', s_maxx-len(statusline))
+        self.drawn = (statusline, s_maxx)
+        self.screen.noutrefresh()
+        # return nothing
+        return
+
+
+# keys around text pasted in bracketed paste mode, after ESC
+PASTE_START = [ord(c) for c in '[200~']
+PASTE_END = [ord(c) for c in '[201~']
 
 
 class ScrollTextbox():
@@ -24,9 +1480,13 @@ class ScrollTextbox():
     Ctrl-N      Cursor down; move down one line.
     Ctrl-O      Insert a blank line at cursor location.
     Ctrl-P      Cursor up; move up one line.
+    Ctrl-R      Redo the last undone edit.
+    Ctrl-U      Undo the last edit.
 
     Move operations do nothing if the cursor is at an edge where the movement
-    is not possible.  The following synonyms are supported where possible:
+    is not possible.  Long lines scroll sideways a page at a time, pages
+    after the first starting with '<', and '>' marks a line going on past
+    the page.  The following synonyms are supported where possible:
 
     KEY_LEFT = Ctrl-B,
     KEY_RIGHT = Ctrl-F,
@@ -35,17 +1495,29 @@ class ScrollTextbox():
     KEY_BACKSPACE = Ctrl-H
     """
 
-    def __init__(self, win):
+    # milliseconds between checks for new highlighting while idle
+    POLL_MS = 100
+
+    def __init__(self, win, damage, status):
         """Initialize the object"""
         self.win = win
+        self.damage = damage
+        self.status = status
         self.win.keypad(1)
         self.win.idlok(True)
         self.win.scrollok(True)
         self.line_num = 0
         self.top_line_num = 0
-        self.x_indx = [1]
-        self.text = [""]
+        self.x_indx = PageIndex()
+        self.text = TextBuffer()
+        self.highlighter = Highlighter(self.text)
+        self.journal = UndoJournal(self.text)
+        # SearchIndex of the last search, None for none
+        self.search = None
+        # functions adding text while idle, returning True if they did
+        self.feeds = []
         self.save_needed = False
+        self.pasting = False
         self._update_max_yx()
 
     def toggle_save_needed(self, bool):
@@ -60,18 +1532,38 @@ class ScrollTextbox():
         self.maxy = maxy - 1
         self.maxx = maxx - 1
 
-    def _brackets(self, cmd, bracket):
-        """Add/remove brackets for the begining/end of the line"""
-        if cmd == "normal":
-            if bracket == ">":
-                self.win.addch(self.win.getyx()[0], self.maxx, ' ', A_NORMAL)
-            elif bracket == "<":
-                self.win.addch(self.win.getyx()[0], 0, ' ', A_NORMAL)
-        elif cmd == "reverse":
-            if bracket == ">":
-                self.win.addch(self.win.getyx()[0], self.maxx, '>', A_REVERSE)
-            elif bracket == "<":
-                self.win.addch(self.win.getyx()[0], 0, '<', A_REVERSE)
+    def _page_col(self, page):
+        """Return the column of the first character a page of a line shows"""
+        # the first page shows maxx characters, later pages start with '<'
+        if page == 1:
+            return 0
+        return self.maxx + (page-2)*max(1, self.maxx-1)
+
+    def _col_page(self, col):
+        """Return the page of a line that shows column col"""
+        if col < self.maxx:
+            return 1
+        return (col - self.maxx) // max(1, self.maxx-1) + 2
+
+    def _screen_x(self, page, col):
+        """Return the window column showing column col on a page"""
+        shift = 0 if page == 1 else 1
+        return col - self._page_col(page) + shift
+
+    def _cursor_col(self, x):
+        """Return the column of the current line under window column x"""
+        page = self.x_indx[self.line_num]
+        shift = 0 if page == 1 else 1
+        return self._page_col(page) + max(0, x - shift)
+
+    def _goto_col(self, y, col):
+        """Move the cursor to column col of the current line on row y, paging to it"""
+        page = self.x_indx[self.line_num]
+        if not self._page_col(page) <= col < self._page_col(page+1):
+            page = self._col_page(col)
+            self.x_indx[self.line_num] = page
+            self.damage.touch(y)
+        self.win.move(y, self._screen_x(page, col))
         # return nothing
         return
 
@@ -81,112 +1573,63 @@ class ScrollTextbox():
         """Process a single editing command."""
         self._update_max_yx()
         (y, x) = self.win.getyx()
+        # commands draw on the cursor row directly
+        self.damage.touch(y)
 
         # print character, if printable
         if curses.ascii.isprint(ch):
             self.toggle_save_needed(True)
-            if self.line_num > len(self.text) - 1:
-                for line_num in range(len(self.text),self.line_num+1):
-                    self.text.append("")
-                    self.x_indx.append(1)
-            if x > len(self.text[self.line_num]) - 1:
-                self.text[self.line_num] += " " * (x - len(self.text[self.line_num]))
-            if x == self.maxx:
-                self.x_indx[self.line_num] += 1
-                x_coord = (self.x_indx[self.line_num]-1)*self.maxx
-                self.win.addstr(y, 1, self.text[self.line_num][x_coord:x_coord+self.maxx])
-                self._brackets("reverse", "<")
-                self._brackets("reverse", ">")
-                if len(self.text[self.line_num][x_coord:]) < self.maxx:
-                    self.win.move(y, len(self.text[self.line_num][x_coord:]))
-                    self.win.clrtoeol()
-                self.win.move(y, 1)
-            self.win.addch(ch)
-            x_coord = (self.x_indx[self.line_num]-1)*self.maxx
-            self.text[self.line_num] = self.text[self.line_num][:x_coord+x] + chr(ch) + self.text[self.line_num][x_coord+x+1:]
+            col = self._cursor_col(x)
+            self.text.set_char(self.line_num, col, chr(ch))
+            self._goto_col(y, col+1)
 
         # Ctrl-a (Go to left edge of window)
         elif ch == curses.ascii.SOH:                           # ^a
-            self.x_indx[self.line_num] = 1
-            self.win.move(y, 0)
-            self.win.addstr(self.text[self.line_num])
-            if len(self.text[self.line_num]) > self.maxx:
-                self._brackets("reverse", ">")
+            self._goto_col(y, 0)
 
-        # Ctrl-b (Cursor left, wrapping to previous line if appropriate (backspace doesn't work))
+        # Ctrl-b (Cursor left, wrapping to previous line if appropriate (backspace also deletes))
         elif ch in (curses.ascii.STX, curses.KEY_LEFT, curses.ascii.BS, curses.KEY_BACKSPACE):     # ^b
-            if x > 0 and self.x_indx[self.line_num] == 1:
-                self.win.move(y, x-1)
-            elif self.x_indx[self.line_num] > 1:
-                if x > 1:
-                    self.win.move(y, x-1)
-                else:
-                    self.x_indx[self.line_num] -= 1
-                    x_coord = (self.x_indx[self.line_num]-1)*self.maxx
-                    if len(self.text[self.line_num]) > (self.x_indx[self.line_num]*self.maxx - 1):
-                        self.win.addstr(y, 1, self.text[self.line_num][x_coord:])
-                        self._brackets("reverse", ">")
-                        self.win.move(y, self.maxx-1)
-                    else:
-                        self.win.addstr(y, 0, self.text[self.line_num][x_coord:])
-                        self.win.move(y, len(self.text[self.line_num][x_coord:]))
-                        self.win.clrtoeol()
-                    if self.x_indx[self.line_num] > 1:
-                        self._brackets("reverse", "<")
-            elif y == 0:
-                if self.line_num > 0:
+            col = self._cursor_col(x)
+            if col > 0:
+                self._goto_col(y, col-1)
+                if ch in (curses.ascii.BS, curses.KEY_BACKSPACE):
+                    self.toggle_save_needed(True)
+                    self.text.delete_char(self.line_num, col-1)
+            elif self.line_num > 0:
+                if y == 0:
                     self.win.scroll(-1)
-                    self.line_num -= 1
+                    self.damage.invalidate()
                     self.top_line_num -= 1
-                    self.win.move(y, 0)
-                    self.win.addstr(self.text[self.line_num])
-                    if len(self.text[self.line_num]) > (self.maxx - 1):
-                        self._brackets("reverse", ">")
-                        self.win.move(y, self.maxx-1)
-                    else:
-                        self.win.move(y, len(self.text[self.line_num]))
-            else:
-                self.win.move(y-1, 0)
+                    y += 1
                 self.line_num -= 1
-            if ch in (curses.ascii.BS, curses.KEY_BACKSPACE):
-                self.win.delch()
-                x_coord = (self.x_indx[self.line_num]-1)*self.maxx + x
-                self.text[self.line_num] = self.text[self.line_num][:x_coord] + self.text[self.line_num][x_coord+1:]
+                self._goto_col(y-1, self.text.line_len(self.line_num))
 
         # Ctrl-d (Delete character under cursor)
         elif ch == curses.ascii.EOT:                           # ^d
-            self.toggle_save_needed(True)
-            self.win.delch()
-            x_coord = (self.x_indx[self.line_num]-1)*self.maxx + x
-            self.text[self.line_num] = self.text[self.line_num][:x_coord] + " " + self.text[self.line_num][x_coord+1:]
-            if len(self.text[self.line_num][x_coord:]) < self.maxx:
-                self._brackets("normal", ">")
+            col = self._cursor_col(x)
+            if col < self.text.line_len(self.line_num):
+                self.toggle_save_needed(True)
+                self.text.set_char(self.line_num, col, " ")
 
-        # Ctrl-e (Go to right edge)
+        # Ctrl-e (Go to end of line)
         elif ch == curses.ascii.ENQ:                           # ^e
-            if len(self.text[self.line_num]) < self.x_indx[self.line_num]*self.maxx:
-                self.win.move(y, len(self.text[self.line_num]))
-            else:
-                self.win.move(y, self.maxx-1)
+            self._goto_col(y, self.text.line_len(self.line_num))
 
         # Ctrl-f (Cursor right, wrapping to next line when appropriate)
         elif ch in (curses.ascii.ACK, curses.KEY_RIGHT):       # ^f
-            if x == self.maxx-1 and len(self.text[self.line_num]) > self.x_indx[self.line_num]*self.maxx:
-                x_coord = self.x_indx[self.line_num]*self.maxx
-                self.win.addstr(y, 1, self.text[self.line_num][x_coord:])
-                self._brackets("reverse", "<")
-            elif x < self.maxx:
-                self.win.move(y, x+1)
-            elif y == self.maxy and len(self.text[self.line_num]) < self.x_indx[self.line_num]*self.maxx:
-                self.win.scroll(1)
-                self.line_num += 1
-                self.top_line_num += 1
-                self.win.move(y, 0)
-                if self.line_num < len(self.text):
-                    self.win.addstr(self.text[self.line_num])
+            col = self._cursor_col(x)
+            page = self.x_indx[self.line_num]
+            # the cursor may go past the end of the line up to the page edge
+            if col < self.text.line_len(self.line_num) or col+1 < self._page_col(page+1):
+                self._goto_col(y, col+1)
             else:
-                self.win.move(y+1, 0)
+                if y == self.maxy:
+                    self.win.scroll(1)
+                    self.damage.invalidate()
+                    self.top_line_num += 1
+                    y -= 1
                 self.line_num += 1
+                self._goto_col(y+1, 0)
 
         # Ctrl-g (Terminate, returning the window contents)
         elif ch == curses.ascii.BEL:                           # ^g
@@ -199,24 +1642,26 @@ class ScrollTextbox():
             self.toggle_save_needed(True)
             if y == self.maxy:
                 self.win.scroll(1)
+                self.damage.invalidate()
                 self.top_line_num += 1
                 self.win.move(y, 0)
             else:
                 self.win.move(y+1, 0)
             self.win.insertln()
+            self.damage.invalidate()
             self.line_num += 1
-            self.text = self.text[:self.line_num] + [""] + self.text[self.line_num:]
-            self.x_indx = self.x_indx[:self.line_num] + [1] + self.x_indx[self.line_num:]
-            if self.line_num > len(self.text) - 1:
-                self.text.append("")
-                self.x_indx.append(1)
+            self.text.ensure(self.line_num - 1)
+            self.text.insert_line(self.line_num)
+            self.x_indx.shift(self.line_num, 1)
 
         # Ctrl-k (Delete line)
         elif ch == curses.ascii.VT:                            # ^k
             self.toggle_save_needed(True)
             self.win.move(y, 0)
             self.win.deleteln()
-            self.text[self.line_num] = ""
+            self.damage.invalidate()
+            if self.line_num < len(self.text):
+                self.text.set_line(self.line_num, "")
             self.x_indx[self.line_num] = 1
 
         # Ctrl-l (Refresh buffer)
@@ -225,93 +1670,234 @@ class ScrollTextbox():
 
         # Ctrl-n (Cursor down, move down one line)
         elif ch in (curses.ascii.SO, curses.KEY_DOWN):         # ^n
+            col = self._cursor_col(x)
             if y == self.maxy:
                 self.win.scroll(1)
-                self.line_num += 1
+                self.damage.invalidate()
                 self.top_line_num += 1
-                self.win.move(y, 0)
-                if self.line_num < len(self.text):
-                    self.win.addstr(self.text[self.line_num])
-                else:
-                    self.toggle_save_needed(True)
-                    self.text.append("")
-                    self.x_indx.append(1)
-                self.win.move(y, x)
-            else:
-                self.win.move(y+1, x)
-                self.line_num += 1
-                # sanity check #
-                if self.line_num > len(self.text) - 1:
-                    self.toggle_save_needed(True)
-                    for i in range(len(self.text),self.line_num+1):
-                        self.text.append("")
-                        self.x_indx.append(1)
-                # end sanity check #
-            if x > len(self.text[self.line_num]):
-                self.win.move(y+1, len(self.text[self.line_num]))
+                y -= 1
+            self.line_num += 1
+            # sanity check #
+            if self.line_num > len(self.text) - 1:
+                self.toggle_save_needed(True)
+                self.text.ensure(self.line_num)
+            # end sanity check #
+            self._goto_col(y+1, min(col, self.text.line_len(self.line_num)))
 
         # Ctrl-o (Insert a blank line at cursor location)
         elif ch == curses.ascii.SI:                            # ^o
             self.toggle_save_needed(True)
             self.win.insertln()
-            if self.line_num > 0:
-                self.text = self.text[:self.line_num] + [""] + self.text[self.line_num:]
-                self.x_indx = self.x_indx[:self.line_num] + [1] + self.x_indx[sefl.line_num:]
-            else:
-                self.text = [""] + self.text
-                self.x_indx = [1] + self.x_indx
+            self.damage.invalidate()
+            self.text.insert_line(self.line_num)
+            self.x_indx.shift(self.line_num, 1)
             self.win.move(y, 0)
 
         # Ctrl-p (Cursor up, move up one line)
         elif ch in (curses.ascii.DLE, curses.KEY_UP):          # ^p
-            if y > 0:
-                self.win.move(y-1, x)
-                self.line_num -= 1
-            elif self.line_num > 0:
+            col = self._cursor_col(x)
+            if y == 0 and self.line_num > 0:
                 self.win.scroll(-1)
-                self.line_num -= 1
+                self.damage.invalidate()
                 self.top_line_num -= 1
-                self.win.move(y, 0)
-                self.win.addstr(self.text[self.line_num])
-            if x > len(self.text[self.line_num]):
-                self.win.move(y-1, len(self.text[self.line_num]))
-            else:
-                self.win.move(y, x)
+                y += 1
+            if self.line_num > 0:
+                self.line_num -= 1
+                y -= 1
+            self._goto_col(y, min(col, self.text.line_len(self.line_num)))
+
+        # Ctrl-r (Redo the last undone edit)
+        elif ch == curses.ascii.DC2:                           # ^r
+            self._show_edit(self.journal.redo())
+
+        # Ctrl-u (Undo the last edit)
+        elif ch == curses.ascii.NAK:                           # ^u
+            self._show_edit(self.journal.undo())
 
         # return one
         return 1
 
+    def _show_edit(self, where):
+        """Move to the (line number, column) of an undone or redone edit"""
+        if where is None:
+            return
+        self.toggle_save_needed(True)
+        line_num, col = where
+        # lines may have come and gone, so every line goes back to its first page
+        self.x_indx = PageIndex()
+        if line_num < self.top_line_num or line_num > self.top_line_num + self.maxy:
+            self.top_line_num = max(0, line_num - self.maxy // 2)
+        self.line_num = line_num
+        self._goto_col(line_num - self.top_line_num, col)
+        self.damage.invalidate()
+        # return nothing
+        return
+
+
+    def _put_text(self, text):
+        """Write a run of printable characters at the cursor as one edit"""
+        self._update_max_yx()
+        (y, x) = self.win.getyx()
+        self.damage.touch(y)
+        self.toggle_save_needed(True)
+        # the whole run goes in at once, paging along the line as far as it reaches
+        col = self._cursor_col(x)
+        self.text.set_chars(self.line_num, col, text)
+        self._goto_col(y, col + len(text))
+        # return nothing
+        return
+
+    def do_keys(self, keys):
+        """Process a batch of keys, writing runs of printable keys at once"""
+        # the edits of a batch, such as a paste, are undone together
+        self.journal.new_group()
+        i = 0
+        while i < len(keys):
+            ch = keys[i]
+            if ch == curses.ascii.ESC:
+                # bracketed paste markers may still be arriving
+                if len(keys) - i < 6:
+                    self.win.timeout(50)
+                    while len(keys) - i < 6:
+                        more = self.win.getch()
+                        if more == -1:
+                            break
+                        keys.append(more)
+                    self.win.timeout(-1)
+                if keys[i+1:i+6] == PASTE_START:
+                    self.pasting = True
+                    # pasted text is not typing on from the last edit
+                    self.journal.new_group(merge=False)
+                    i += 6
+                    continue
+                if keys[i+1:i+6] == PASTE_END:
+                    self.pasting = False
+                    i += 6
+                    continue
+            if curses.ascii.isprint(ch):
+                j = i + 1
+                while j < len(keys) and curses.ascii.isprint(keys[j]):
+                    j += 1
+                self._put_text(''.join(map(chr, keys[i:j])))
+                i = j
+                continue
+            if self.pasting:
+                # pasted line breaks insert lines, other controls are dropped
+                if ch in (curses.ascii.NL, curses.ascii.CR):
+                    self.do_command(curses.ascii.NL)
+            elif ch and not self.do_command(ch):
+                return 0       # return zero
+            i += 1
+        # return one
+        return 1
+
+    def draw_rows(self, rows=None):
+        """Redraw rows (all by default) that do not show their line yet"""
+        self._update_max_yx()
+        (cy, cx) = self.win.getyx()
+        self.highlighter.show(self.top_line_num, self.maxy + 1)
+        if rows is None:
+            rows = range(0, self.maxy + 1)
+        for y in rows:
+            line_num = self.top_line_num + y
+            page = self.x_indx[line_num]
+            # pages after the first start with '<' in the first column
+            shift = 0 if page == 1 else 1
+            x_coord = self._page_col(page)
+            line = self.text.line_slice(line_num, x_coord, x_coord + self.maxx - shift + 1)
+            # only the spans on the page, found by bisecting on their starts
+            spans = self.highlighter.spans(line_num)
+            first = max(0, bisect_right(spans, (x_coord,)) - 1)
+            spans = spans[first:bisect_left(spans, (x_coord + self.maxx,), first)]
+            if not self.damage.changed(y, (line, page, spans)):
+                continue
+            self.win.move(y, 0)
+            self.win.clrtoeol()
+            self.win.insnstr(y, shift, line, self.maxx - shift)
+            for start, end, attr in spans:
+                start = max(start - x_coord, 0) + shift
+                end = min(end - x_coord + shift, self.maxx)
+                if start < end:
+                    self.win.chgat(y, start, end - start, attr)
+            if shift:
+                self.win.addch(y, 0, '<', A_REVERSE)
+            if len(line) > self.maxx - shift:
+                self.win.insch(y, self.maxx, '>', A_REVERSE)
+        self.win.move(cy, cx)
+        # return nothing
+        return
+
+    def draw_updated(self):
+        """Redraw forgotten rows and rows given new highlighting"""
+        rows = set(self.damage.forgotten)
+        for line_num in self.highlighter.take_updated():
+            if 0 <= line_num - self.top_line_num <= self.maxy:
+                rows.add(line_num - self.top_line_num)
+        self.draw_rows(sorted(rows))
+        return len(rows)
+
+    def update_status(self, buffer_num, message=""):
+        """Set the statusline fields of the text box and draw them"""
+        self.status.set('buffer', 'Buffer ' + str(buffer_num))
+        self.status.set('cursor', 'Row ' + str(self.line_num) + ' Col ' + str(self._cursor_col(self.win.getyx()[1])))
+        size = self.journal.size
+        for unit in ('B', 'K', 'M', 'G'):
+            if size < 1024:
+                break
+            size //= 1024
+        self.status.set('undo', 'Undo ' + str(size) + unit)
+        self.status.draw(message)
+        # return nothing
+        return
 
-    def edit(self, stdscr, buffer_num):
+    def edit(self, buffer_num):
         """Edit in the widget window"""
-        while 1:
+        editing = 1
+        while editing:
+            # wake up now and then to show highlighting lexed meanwhile
+            self.win.timeout(self.POLL_MS)
             ch = self.win.getch()
+            if ch == -1:
+                fed = True in [feed() for feed in self.feeds]
+                if fed:
+                    self.draw_rows()
+                if self.draw_updated() or fed:
+                    self.win.noutrefresh()
+                    curses.doupdate()
+                continue
             if not ch:
                 continue
-            if not self.do_command(ch):
-                break
-            # update statusline (y, x)
-            s_maxy, s_maxx = stdscr.getmaxyx()
-            # statuline string
-            statusline = '### Buffer '+ str(buffer_num) + ' ' + '# Row ' + str(self.line_num) + ' Col ' + str(self.win.getyx()[1]) + ' '
-            # redraw bottom hline (statusline)
-            stdscr.addstr(s_maxy-2, 0, statusline)
-            stdscr.hline(s_maxy-2, len(statusline) , '#', s_maxx-len(statusline))
-            stdscr.refresh()
+            # take keys already waiting too, such as a paste
+            keys = [ch]
+            self.win.nodelay(True)
+            ch = self.win.getch()
+            while ch != -1:
+                keys.append(ch)
+                ch = self.win.getch()
+            self.win.nodelay(False)
+            editing = self.do_keys(keys)
+            # redraw once the whole paste is in
+            if editing and self.pasting:
+                continue
+            # redraw rows the keys changed, then update statusline (y, x)
+            self.draw_updated()
+            self.update_status(buffer_num)
             # need to refresh win after screen for cursor to appear in win
-            self.win.refresh()
+            self.win.noutrefresh()
+            curses.doupdate()
+        self.win.timeout(-1)
         # return nothing
         return
 
 
 class Buffer():
-    def __init__(self, stdscr):
+    def __init__(self, stdscr, damage, status):
         """Create new buffer for editing"""
         # get screen dimensions
         maxy, maxx = stdscr.getmaxyx()
         # setup text box
         win = stdscr.subwin(maxy-2, maxx, 0, 0)
-        self.text_box = ScrollTextbox(win)
+        self.text_box = ScrollTextbox(win, damage, status)
 
 
 class Buffers():
@@ -327,8 +1913,11 @@ class Buffers():
         self.cmd_box = Textbox(cmdline)
         self.cmd_box.stripspaces = True
         self.cmd = 'edit'
+        # text area rows and statusline, shared by all buffers
+        self.damage = Damage(maxy-2)
+        self.status = StatusLine(self.screen)
         # initialize first buffer
-        self.buffers = [Buffer(self.screen)]
+        self.buffers = [Buffer(self.screen, self.damage, self.status)]
         self.buffer_num = 0
         self.current_buffer = self.buffers[0]
         # update the buffer
@@ -338,60 +1927,100 @@ class Buffers():
 
     def add_buffer(self):
         """Add a buffer"""
-        self.buffers.append(Buffer(self.screen))
+        self.buffers.append(Buffer(self.screen, self.damage, self.status))
         self.buffer_num = len(self.buffers) - 1
         self.current_buffer = self.buffers[-1]
         # return nothing
         return
 
-    def get_cmd(self):
+    def get_cmd(self, lower=True):
         """Get a command from commandline"""
         self.cmd_box.win.clear()
         self.cmd_box.win.refresh()
-        self.cmd = self.cmd_box.edit().strip(' ').lower()
+        self.cmd = self.cmd_box.edit().strip(' ')
+        if lower:
+            self.cmd = self.cmd.lower()
         # return nothing
         return
 
-    def update_statusline(self, status):
-        """Update the statusline"""
+    def get_search(self):
+        """Get a search pattern from commandline, returning (pattern, is_regex, message)
+
+        A bad regex gives an empty pattern and a message to show on the
+        statusline, otherwise the message is empty.
+        """
+        self.update_statusline('Search For (/regex/): ')
+        self.get_cmd(lower=False)
+        pattern = self.cmd
+        if len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/'):
+            # check the regex here, searches compile it in the background
+            try:
+                re.compile(pattern[1:-1])
+            except re.error:
+                return "", False, 'Error: Bad Regex'
+            return pattern[1:-1], True, ""
+        return pattern, False, ""
+
+    def start_search(self, buffer, pattern, is_regex):
+        """Start a search of a buffer, replacing its last search"""
+        t_box = buffer.text_box
+        if t_box.search is not None:
+            t_box.search.stop()
+        t_box.search = SearchIndex(t_box.text, pattern, is_regex)
+        # return nothing
+        return
+
+    def goto_match(self, forward=True, line_num=None):
+        """Show the next search match at the top of the text box, with the cursor on it"""
         t_box = self.current_buffer.text_box
-        s_maxy, s_maxx = self.screen.getmaxyx()
-        # statuline string
-        if len(status) > 0:
-            statusline = '### ' + status + ' '
-        else:
-            statusline = '### Buffer '+ str(self.buffer_num) + ' ' + '# Row ' + str(t_box.line_num) + ' Col ' + str(t_box.win.getyx()[1]) + ' '
-        # redraw bottom hline (statusline)
-        self.screen.addstr(s_maxy-2, 0, statusline)
-        self.screen.hline(s_maxy-2, len(statusline) , '#', s_maxx-len(statusline))
-        self.screen.refresh()
+        if t_box.search is None:
+            return self.edit_default_text_box(message='Error: No Search')
+        if line_num is None:
+            line_num = t_box.line_num
+        self.update_statusline('Searching...')
+        match = t_box.search.find(line_num, forward)
+        if match is None:
+            return self.edit_default_text_box(message='Not Found')
+        # go to the page of the line with the match on it
+        col = t_box.search.column(match)
+        t_box._update_max_yx()
+        t_box.x_indx[match] = t_box._col_page(col)
+        x = t_box._screen_x(t_box.x_indx[match], col)
+        t_box.top_line_num = match
+        self.update_buffer()
+        return self.edit_default_text_box(x)
+
+    def search_results_feed(self, t_box, searches):
+        """Return a text box feed listing matches of searches as they are found"""
+        # searches are (buffer number, buffer) pairs
+        searches = [(b, buff.text_box.text, buff.text_box.search) for b, buff in searches]
+        reported = [0] * len(searches)
+        def feed():
+            fed = False
+            for s, (b, text, search) in enumerate(searches):
+                found = search.since(reported[s])
+                for line_num in found:
+                    t_box.text.append('Buffer ' + str(b) + ' Line ' + str(line_num) + ': ' + text.line(line_num))
+                    fed = True
+                reported[s] += len(found)
+            return fed
+        return feed
 
+    def update_statusline(self, status):
+        """Update the statusline"""
+        self.current_buffer.text_box.update_status(self.buffer_num, status)
+        curses.doupdate()
         # return nothing
         return
 
     def update_text(self):
-        """Redisplay text box text"""
+        """Redisplay text box text, skipping rows that already show their line"""
         t_box = self.current_buffer.text_box
         # display text
-        t_box.win.move(0, 0)
-        maxy, maxx = t_box.win.getmaxyx()
-        minline = t_box.top_line_num
-        if maxy < len(t_box.text):
-            maxline = minline + maxy
-        else:
-            maxline = minline + len(t_box.text)
-        for line in t_box.text[minline:maxline+1]:
-            y = t_box.win.getyx()[0]
-            t_box.win.insnstr(line, maxx)
-            if len(line) > maxx:
-                t_box.win.insch(y, maxx, '>', A_REVERSE)
-            if y == maxy - 1:
-                break
-            else:
-                t_box.win.move(y+1, 0)
+        t_box.draw_rows()
         t_box.line_num = t_box.top_line_num
         t_box.win.move(0, 0)
-        t_box.win.refresh()
+        t_box.win.noutrefresh()
         # return nothing
         return
 
@@ -401,7 +2030,6 @@ class Buffers():
             # Update the buffer number
             self.buffer_num = buffer_num
             self.current_buffer = self.buffers[buffer_num]
-        self.screen.clear()
         # redisplay text
         self.update_text()
         # update statusline
@@ -409,21 +2037,23 @@ class Buffers():
         # return nothing
         return
 
-    def edit_default_text_box(self):
-        """Edit default text box"""
+    def edit_default_text_box(self, x=0, message=""):
+        """Edit default text box, showing message on the statusline until a key is pressed"""
         text_box = self.current_buffer.text_box
-        # move cursor to top left corner
+        # move cursor to top left corner (or x along the top line)
         text_box.line_num = text_box.top_line_num
-        text_box.win.move(0, 0)
-        self.update_statusline("")
+        text_box.win.move(0, x)
+        self.update_statusline(message)
         # edit text box
-        return text_box.edit(self.screen, self.buffer_num)
+        return text_box.edit(self.buffer_num)
 
     def del_buffer(self):
         """Delete current buffer and update buffer number (and current buffer)"""
         # remove buffer and associated objects
-        self.screen.clear()
-        self.screen.refresh()
+        self.current_buffer.text_box.highlighter.stop()
+        if self.current_buffer.text_box.search is not None:
+            self.current_buffer.text_box.search.stop()
+        self.current_buffer.text_box.text.close()
         del self.buffers[self.buffer_num]
         # update buffer number (and buffer)
         if self.buffer_num > 0:
@@ -479,7 +2109,7 @@ class Buffers():
                 self.update_buffer()
                 # set text box help text
                 t_box = self.current_buffer.text_box
-                t_box.text = [
+                t_box.text.replace([
 "              Help Page              ",
 "-------------------------------------",
 "====  Text Box Commands  ====",
@@ -496,6 +2126,8 @@ class Buffers():
 "Ctrl-N = Cursor down; move down one line",
 "Ctrl-O = Insert a blank line at cursor location",
 "Ctrl-P = Cursor up; move up one line",
+"Ctrl-R = Redo the last undone edit",
+"Ctrl-U = Undo the last edit",
 "---------------------------------",
 "====  Command Line Commands  ====",
 "'h[elp]' = display help page",
@@ -505,7 +2137,11 @@ class Buffers():
 "'b[uffer]' = go to next buffer",
 "'f[ile ]s[ave[ as]]' = save to file",
 "'f[ile ]o[pen]' = open file",
-"'o[pen buffers]' = list open buffers in new buffer"]
+"'s[earch]' = search buffer (/regex/ for a regular expression)",
+"'sn' or 'search next' = go to next match",
+"'sp' or 'search previous' = go to previous match",
+"'sa' or 'search all' = search all buffers, listing matches in new buffer",
+"'o[pen buffers]' = list open buffers in new buffer"])
                 # display help text
                 self.update_buffer()
                 # edit the text box
@@ -519,11 +2155,11 @@ class Buffers():
                 self.update_buffer()
                 # set text box header text
                 t_box = self.current_buffer.text_box
-                t_box.text = [
+                t_box.text.replace([
 "==========  Open buffers Buffer  ==========",
 " Warning: This buffer will not auto update ",
 "      Recommended to remove when done      ",
-"==========================================="]
+"==========================================="])
                 # get open buffers
                 for b,buff in enumerate(self.buffers):
                     if b == len(self.buffers) - 1:
@@ -581,15 +2217,10 @@ class Buffers():
 
                 # update statusline
                 self.update_statusline('Saving File...')
-                # get text for saving
-                text_to_save = ""
-                for line_of_text in t_box.text:
-                    text_to_save += line_of_text + '\n'
 
                 # try to save file
                 try:
-                    with open(filename, 'w') as file:
-                        file.write(text_to_save)
+                    t_box.text.save(filename)
                     # update statusline if successful
                     self.update_statusline('Save Successful')
                     # No save needed anymore, at least until another edit
@@ -601,9 +2232,6 @@ class Buffers():
                 except: # update statusline if failed
                     self.update_statusline('Error: File Save Failed')
 
-                # free up var for memory (could be large file)
-                del text_to_save
-
                 # edit default text box with updated statusline
                 self.edit_default_text_box()
 
@@ -616,33 +2244,72 @@ class Buffers():
                 self.get_cmd()
                 filename = self.cmd
 
-                # var to hold text
-                text_from_file = ""
-                # try to open file
+                # var to hold mapped file
+                mapped_file = None
+                # try to open file (lines are indexed in the background and
+                # only decoded when displayed, so large files open at once)
                 try:
-                    with open(filename, 'r') as file:
-                        text_from_file = file.readlines()
+                    mapped_file = MappedFile(filename)
                 except: # update statusline if failed
                     self.update_statusline('Error: File Open Failed')
 
-                # if any text read from file, add to buffer
-                if len(text_from_file) > 0:
-                    t_box.text = []
-                    for line in text_from_file:
-                        t_box.text.append(line.strip('\n'))
+                # if file has any text, add to buffer
+                if mapped_file is not None and mapped_file.size > 0:
+                    t_box.text.load(mapped_file)
+                    t_box.x_indx.clear()
 
-                    # free up var for memory (could be large file)
-                    del text_from_file
+                    # wait for the first screen of lines to be indexed
+                    mapped_file.wait(t_box.maxy + 1)
 
                     # update buffer for displaying the text
                     self.current_buffer.text_box.line_num = 0
                     self.current_buffer.text_box.top_line_num = 0
                     self.update_buffer()
+                elif mapped_file is not None:
+                    mapped_file.close()
 
                 # edit default text box
                 self.edit_default_text_box()
 
 
+            # COMMAND: search buffer
+            elif self.cmd == 's' or self.cmd == 'search':
+                pattern, is_regex, message = self.get_search()
+                if len(pattern) > 0:
+                    self.start_search(self.current_buffer, pattern, is_regex)
+                    # search from the line at the top of the text box
+                    self.goto_match(line_num=t_box.top_line_num-1)
+                else:
+                    self.edit_default_text_box(message=message)
+
+
+            # COMMAND: next/previous search match
+            elif self.cmd == 'sn' or self.cmd == 'search next':
+                self.goto_match()
+            elif self.cmd == 'sp' or self.cmd == 'search previous':
+                self.goto_match(forward=False)
+
+
+            # COMMAND: search all buffers
+            elif self.cmd == 'sa' or self.cmd == 'search all':
+                pattern, is_regex, message = self.get_search()
+                if len(pattern) > 0:
+                    searches = list(enumerate(self.buffers))
+                    for b, buff in searches:
+                        self.start_search(buff, pattern, is_regex)
+                    self.add_buffer()
+                    # set text box header text
+                    t_box = self.current_buffer.text_box
+                    t_box.text.replace([
+"==========  Search Results Buffer  ==========",
+" Matches are listed as they are found, but   ",
+" will not update after edits                 ",
+"=============================================="])
+                    t_box.feeds.append(self.search_results_feed(t_box, searches))
+                    self.update_buffer()
+                self.edit_default_text_box(message=message)
+
+
             # FINALLY: get cmd from cmdline
             self.get_cmd()
             # if no cmd entered, edit text box
@@ -662,11 +2329,16 @@ class Buffers():
 
 def main(stdscr):
     """The Main Program"""
-    ### Initialize Emacs ###
-    emacs = Buffers(stdscr)
-    ### MAIN PROGRAM ###
-    emacs.mainloop()
-    ### END OF MAIN PROGRAM ###
+    # have the terminal mark pasted text (bracketed paste mode)
+    print('\033[?2004h', end='', flush=True)
+    try:
+        ### Initialize Emacs ###
+        emacs = Buffers(stdscr)
+        ### MAIN PROGRAM ###
+        emacs.mainloop()
+        ### END OF MAIN PROGRAM ###
+    finally:
+        print('\033[?2004l', end='', flush=True)
     return
 
 
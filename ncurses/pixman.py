@@ -2,36 +2,442 @@
 
 import curses
 import curses.panel
+import itertools
+import locale
+import os
+import sys
+import time
+
+from array import array
+from collections import OrderedDict
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# the sixel encoder is shared with ansi/randpix.py, ahead of any installed
+# module of the name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ansi'))
+import sixel
+
+
+# 4x4 Bayer matrix, the order in which pixels round up when dithering
+BAYER = ((0, 8, 2, 10), (12, 4, 14, 6), (3, 11, 1, 9), (15, 7, 13, 5))
+# levels of red, green and blue a pixel keeps, 5 bits each of its color
+LEVELS = 32
+COLOR = 0x7fff
+# flags of a pixel above its color, one being set and one blinking
+SET = 0x8000
+BLINK = 0x10000
+# pixel levels of the 6 levels set_pixel takes
+LEVEL6 = tuple(((LEVELS - 1) * 2 * v + 5) // 10 for v in range(0, 6))
+# lines and columns of pixels in a cell, for each render mode
+MODES = {'cell': (1, 1), 'half': (2, 1), 'braille': (4, 2)}
+# glyphs of the half mode, drawing the fg color in the whole, upper or
+# lower half of a cell and the bg color in the rest
+FULL, UPPER, LOWER = '\u2588', '\u2580', '\u2584'
+# bit of each dot of a braille glyph, line by line
+BRAILLE_BITS = (0x01, 0x08, 0x02, 0x10, 0x04, 0x20, 0x40, 0x80)
+
+
+def pixel_color(rgb):
+  # color of a pixel of r, g, b each ranging from 0 to 5
+  r, g, b = rgb
+  return LEVEL6[r] << 10 | LEVEL6[g] << 5 | LEVEL6[b]
+
+
+def color_levels(color):
+  # r, g, b of a pixel's color, each ranging from 0 to 5
+  return tuple((10 * v + LEVELS - 1) // (2 * (LEVELS - 1)) for v in (color >> 10, color >> 5 & 0x1f, color & 0x1f))
+
+
+def color_rgb(color):
+  # r, g, b of a pixel's color, each ranging from 0 to 1000 as in curses
+  return tuple((1000 * v + (LEVELS - 1) // 2) // (LEVELS - 1) for v in (color >> 10, color >> 5 & 0x1f, color & 0x1f))
+
+
+def rgb_color(rgb):
+  # pixel color of r, g, b each ranging from 0 to 1000 as in curses
+  r, g, b = (((LEVELS - 1) * v + 500) // 1000 for v in rgb)
+  return r << 10 | g << 5 | b
+
+
+def terminal_color(color):
+  # r, g, b of a color of a terminal that cannot change colors, ranging
+  # from 0 to 1000; curses only knows the first 16, the rest are taken to
+  # be xterm's 6x6x6 cube and 24 greys
+  if color < 16:
+    return curses.color_content(color)
+  if color < 232:
+    color -= 16
+    return tuple(0 if v == 0 else (55 + 40 * v) * 1000 // 255 for v in (color // 36, color // 6 % 6, color % 6))
+  return ((8 + 10 * (color - 232)) * 1000 // 255,) * 3
+
+
+def color_distance(a, b):
+  # squared distance between two pixel colors
+  return ((a >> 10) - (b >> 10))**2 + ((a >> 5 & 0x1f) - (b >> 5 & 0x1f))**2 + ((a & 0x1f) - (b & 0x1f))**2
+
+
+class ColorPairs():
+  """Colors and color pairs defined as cells are drawn in them
+
+  A color is defined in curses the first time a cell is drawn in it, and
+  so is a pair of two colors, as many as the terminal holds and
+  color_pair can address.  Once all are taken, the one drawn least
+  recently is defined anew, and evicted is set, as cells still showing it
+  would change colors.  A frame needing more than all of them sets
+  overflowed, to be drawn again with colors cut to fewer levels, a step
+  of STEPS at a time; at the last, the nearest pair is taken.  Once what
+  a frame drew would fit with a step more levels, refine goes back that
+  step for all to be drawn again, and should that overflow, it is not
+  tried again for twice as many frames as before.  A terminal that cannot change colors has its own taken
+  as they are.
+  """
+
+  # levels of each of r, g and b colors are cut to, the last being the 6
+  # levels of set_pixel
+  STEPS = (LEVELS, 16, 8, 6)
+  # most frames refine waits for after it overflowed
+  MAX_BACKOFF = 256
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self, ncolors=0, npairs=0, fixed=()):
+    # ncolors colors after color 0, black, and npairs pairs after pair 0;
+    # fixed are the (color, r, g, b) of a terminal that cannot change
+    # colors, r, g, b ranging from 0 to 1000 as in curses
+    self.free_colors = list(range(ncolors, 0, -1))
+    self.free_pairs = list(range(npairs, 0, -1))
+    self.ncolors = ncolors
+    self.npairs = npairs
+    # pixel color -> [curses color, frame last drawn], and (fg, bg) ->
+    # [curses pair, frame last drawn, fg color, bg color], least recently
+    # drawn first
+    self.colors = OrderedDict()
+    self.pairs = OrderedDict()
+    self.fixed = len(fixed) > 0
+    if self.fixed:
+      self.free_colors = []
+      for number, r, g, b in fixed:
+        color = rgb_color((r, g, b))
+        if color != 0:
+          self.colors.setdefault(color, [number, 0])
+    self.frame = 0
+    self.clear()
+    self.next_frame()
+
+  def next_frame(self, redraw=False):
+    # start a frame, redraw telling it draws the cells of the last again
+    self.frame += 1
+    if not redraw and self.refined:
+      # what refine went back a step for fit
+      self.refined = False
+      self.backoff = 1
+    self.evicted = False
+    self.overflowed = False
+    # (fg, bg) -> nearest pair, in this frame
+    self.nearest = {}
+
+  def _cut_to(self, step):
+    self.step = step
+    levels = self.STEPS[step]
+    # the levels kept run from 0 to LEVELS - 1 evenly, as do the colors
+    self.cut = tuple(((v * (levels - 1) * 2 + LEVELS - 1) // (2 * (LEVELS - 1)) * (LEVELS - 1) * 2 + levels - 1) // (2 * (levels - 1)) for v in range(0, LEVELS))
+
+  def coarsen(self):
+    # cut colors a step more, False if they cannot be cut more
+    if self.step == len(self.STEPS) - 1:
+      return False
+    if self.refined:
+      self.refined = False
+      self.held = self.frame + self.backoff
+      self.backoff = min(2 * self.backoff, self.MAX_BACKOFF)
+    self._cut_to(self.step + 1)
+    return True
+
+  def refine(self):
+    # cut colors a step less if the colors and pairs drawn in this frame
+    # would still fit, each level splitting into the finer ones cut to it;
+    # False if not
+    if self.step == 0 or self.frame < self.held:
+      return False
+    cut = self.cut
+    finer = self.STEPS[self.step - 1]
+    finer_cut = tuple(((v * (finer - 1) * 2 + LEVELS - 1) // (2 * (LEVELS - 1)) * (LEVELS - 1) * 2 + finer - 1) // (2 * (finer - 1)) for v in range(0, LEVELS))
+    splits = {}
+    for v in range(0, LEVELS):
+      splits.setdefault(cut[v], set()).add(finer_cut[v])
+    def split(color):
+      return len(splits[color >> 10]) * len(splits[color >> 5 & 0x1f]) * len(splits[color & 0x1f])
+    colors = sum(split(color) for color, (_, drawn) in self.colors.items() if drawn == self.frame and color != 0)
+    pairs = sum(split(fg) * (split(bg) if bg != 0 else 1) for (fg, bg), entry in self.pairs.items() if entry[1] == self.frame)
+    if (colors > self.ncolors and not self.fixed) or pairs > self.npairs:
+      return False
+    self._cut_to(self.step - 1)
+    self.refined = True
+    return True
+
+  def clear(self):
+    # nothing is drawn any more, so colors get all their levels
+    self._cut_to(0)
+    self.refined = False
+    self.held = 0
+    self.backoff = 1
+
+  def color(self, color):
+    # (color taken for a pixel color, its curses color), black being
+    # color 0 for good
+    if color == 0:
+      return (0, 0)
+    entry = self.colors.get(color)
+    if entry is None:
+      if len(self.free_colors) > 0:
+        number = self.free_colors.pop()
+      elif len(self.colors) == 0:
+        return (0, 0)
+      else:
+        old, (number, drawn) = next(iter(self.colors.items()))
+        if self.fixed or drawn == self.frame:
+          self.overflowed |= not self.fixed
+          return self.color(min(self.colors, key=lambda other: color_distance(color, other)))
+        del self.colors[old]
+        # pairs of the color go with it
+        for key, (pair, _, fg, bg) in list(self.pairs.items()):
+          if old in (fg, bg):
+            del self.pairs[key]
+            self.free_pairs.append(pair)
+        self.evicted = True
+      curses.init_color(number, *color_rgb(color))
+      entry = self.colors[color] = [number, self.frame]
+    self.colors.move_to_end(color)
+    entry[1] = self.frame
+    return (color, entry[0])
+
+  def pair(self, fg, bg):
+    # curses pair of pixel colors fg on bg
+    if self.step > 0:
+      cut = self.cut
+      fg = cut[fg >> 10] << 10 | cut[fg >> 5 & 0x1f] << 5 | cut[fg & 0x1f]
+      bg = cut[bg >> 10] << 10 | cut[bg >> 5 & 0x1f] << 5 | cut[bg & 0x1f]
+    key = (fg, bg)
+    entry = self.pairs.get(key)
+    if entry is not None and entry[1] == self.frame:
+      return entry[0]
+    if entry is None:
+      if len(self.free_pairs) == 0 and len(self.pairs) > 0:
+        old = next(iter(self.pairs))
+        if self.pairs[old][1] == self.frame:
+          self.overflowed = True
+          if self.step < len(self.STEPS) - 1:
+            # the frame is drawn again with fewer colors
+            return 0
+          if key not in self.nearest:
+            self.nearest[key] = min(self.pairs, key=lambda other: color_distance(fg, other[0]) + color_distance(bg, other[1]))
+          key = self.nearest[key]
+          entry = self.pairs[key]
+        else:
+          self.free_pairs.append(self.pairs.pop(old)[0])
+          self.evicted = True
+      if len(self.free_pairs) == 0 and entry is None:
+        return 0
+    if entry is None:
+      number = self.free_pairs.pop()
+      fg, fg_number = self.color(fg)
+      bg, bg_number = self.color(bg)
+      curses.init_pair(number, fg_number, bg_number)
+      entry = self.pairs[key] = [number, self.frame, fg, bg]
+    else:
+      # its colors are drawn too
+      for color in entry[2:]:
+        if color != 0:
+          self.colors.move_to_end(color)
+          self.colors[color][1] = self.frame
+    self.pairs.move_to_end(key)
+    entry[1] = self.frame
+    return entry[0]
+
+
+# the colors and pairs of the display server
+color_pairs = ColorPairs()
+
+
+def changed_span(old, new):
+  # first index where two arrays of cells differ and one past the last,
+  # None if they are the same
+  if old == new:
+    return None
+  if numpy is not None:
+    changed = numpy.flatnonzero(numpy.frombuffer(old, numpy.uint32) != numpy.frombuffer(new, numpy.uint32))
+    return (int(changed[0]), int(changed[-1]) + 1)
+  lo, hi = 0, len(new)
+  while old[lo] == new[lo]:
+    lo += 1
+  while old[hi - 1] == new[hi - 1]:
+    hi -= 1
+  return (lo, hi)
+
+
+def pack_cell(pixels, mode):
+  # (glyph, fg, bg, blink) of a cell of pixels, given line by line, the
+  # glyph being None if no pixel is set
+  if not any(pixels):
+    return (None, 0, 0, False)
+  blink = any(pixel & BLINK for pixel in pixels)
+  # no pixel counts as black
+  colors = [pixel & COLOR for pixel in pixels]
+  if mode == 'cell':
+    return ('@', colors[0], 0, blink)
+  if mode == 'half':
+    top, bottom = colors
+    low, high = min(colors), max(colors)
+    # one color, or one on black, needs no pair of two colors
+    fg, bg = (high, 0) if low == 0 or low == high else (low, high)
+    return (FULL if top == bottom else UPPER if top == fg else LOWER, fg, bg, blink)
+  # braille dots show the pixels that are not black, all in the color of
+  # the brightest
+  bits = sum(bit for bit, color in zip(BRAILLE_BITS, colors) if color != 0)
+  fg = max(colors, key=lambda color: (color >> 10) + (color >> 5 & 0x1f) + (color & 0x1f))
+  return (chr(0x2800 + bits), fg, 0, blink)
+
+
+def pack(rows, mode='cell'):
+  """Runs of cells made of rows of pixels, one row for each line of a cell
+
+  Returns (text, length, fg, bg, blink) for each run of cells sharing
+  colors, text being None for cells with no pixel set.  A numpy build
+  packs all cells in one go, otherwise they are packed one by one.
+  """
+  sub_h, sub_w = MODES[mode]
+  ncells = len(rows[0]) // sub_w
+  if numpy is None:
+    cells = [pack_cell([row[x * sub_w + j] for row in rows for j in range(0, sub_w)], mode) for x in range(0, ncells)]
+    packed = []
+    for (is_set, fg, bg, blink), run in itertools.groupby(cells, lambda cell: (cell[0] is not None,) + cell[1:]):
+      glyphs = [glyph for glyph, _, _, _ in run]
+      packed.append((''.join(glyphs) if is_set else None, len(glyphs), fg, bg, blink))
+    return packed
+  if ncells == 0:
+    return []
+  # cell by pixel, the pixels of a cell line by line
+  block = numpy.array([numpy.frombuffer(row, numpy.uint32) for row in rows]).reshape(sub_h, ncells, sub_w).transpose(1, 0, 2).reshape(ncells, sub_h * sub_w)
+  is_set = (block != 0).any(axis=1)
+  blink = ((block & BLINK) != 0).any(axis=1)
+  colors = (block & COLOR).astype(numpy.intp)
+  bg = numpy.zeros(ncells, numpy.intp)
+  if mode == 'cell':
+    codes = numpy.full(ncells, ord('@'))
+    fg = colors[:, 0]
+  elif mode == 'half':
+    top, bottom = colors[:, 0], colors[:, 1]
+    low, high = numpy.minimum(top, bottom), numpy.maximum(top, bottom)
+    one = (low == 0) | (low == high)
+    fg = numpy.where(one, high, low)
+    bg = numpy.where(one, 0, high)
+    codes = numpy.where(top == bottom, ord(FULL), numpy.where(top == fg, ord(UPPER), ord(LOWER)))
+  else:
+    codes = 0x2800 + ((colors != 0) * numpy.array(BRAILLE_BITS)).sum(axis=1)
+    brightness = (colors >> 10) + (colors >> 5 & 0x1f) + (colors & 0x1f)
+    fg = colors[numpy.arange(ncells), brightness.argmax(axis=1)]
+  # a run starts where anything but the glyph changes
+  change = (is_set[1:] != is_set[:-1]) | (fg[1:] != fg[:-1]) | (bg[1:] != bg[:-1]) | (blink[1:] != blink[:-1])
+  starts = [0] + (numpy.flatnonzero(change) + 1).tolist()
+  codes = codes.tolist()
+  return [(''.join(map(chr, codes[start:end])) if is_set[start] else None, end - start, int(fg[start]), int(bg[start]), bool(blink[start])) for start, end in zip(starts, starts[1:] + [ncells])]
+
+
+def subtract_spans(lo, hi, cuts):
+  # pieces of columns lo to hi left after taking out each (lo, hi) of cuts
+  pieces = [(lo, hi)]
+  for cut_lo, cut_hi in cuts:
+    pieces = [piece for piece_lo, piece_hi in pieces for piece in ((piece_lo, min(piece_hi, cut_lo)), (max(piece_lo, cut_hi), piece_hi)) if piece[0] < piece[1]]
+  return pieces
+
+
+def merge_rects(rects):
+  # (top, left, bottom, right) rectangles, bottom and right excluded,
+  # replaced by their bounding box wherever they overlap or touch
+  merged = []
+  for rect in rects:
+    # a grown rectangle may now reach ones merged before
+    while True:
+      top, left, bottom, right = rect
+      for other in merged:
+        if other[0] <= bottom and top <= other[2] and other[1] <= right and left <= other[3]:
+          merged.remove(other)
+          rect = (min(top, other[0]), min(left, other[1]), max(bottom, other[2]), max(right, other[3]))
+          break
+      else:
+        break
+    merged.append(rect)
+  return merged
+
+
+def quantize(pixels, y=0, x=0, levels=False, dither=False):
+  """Pixels, set, of rows of r, g, b pixels
+
+  pixels hold bytes from 0 to 255, rounded to the nearest of the LEVELS
+  levels or, with dither, rounded up or down in a Bayer pattern aligned to
+  y, x on the screen, so a moved image keeps its pattern.  With levels set
+  they range from 0 to 5 as for set_pixel.  A numpy array is quantized in
+  one go into a numpy array, anything else pixel by pixel into lists.
+  """
+  if numpy is not None and isinstance(pixels, numpy.ndarray):
+    pixels = pixels.astype(numpy.intp)
+    if levels:
+      pixels = numpy.array(LEVEL6)[pixels]
+    else:
+      # level = floor(31*v/255 + (2*t+1)/32), t the threshold of the pixel
+      if dither:
+        rows = (numpy.arange(pixels.shape[0]) + y) % 4
+        cols = (numpy.arange(pixels.shape[1]) + x) % 4
+        t = (2 * numpy.array(BAYER) + 1)[numpy.ix_(rows, cols)][..., None]
+      else:
+        t = 16
+      pixels = (32 * (LEVELS - 1) * pixels + 255 * t) // 8160
+    return SET | pixels[..., 0] << 10 | pixels[..., 1] << 5 | pixels[..., 2]
+  quantized = []
+  for i, row in enumerate(pixels):
+    bayer = BAYER[(y + i) % 4]
+    pixel_row = []
+    for j, rgb in enumerate(row):
+      if levels:
+        pixel_row.append(SET | pixel_color(rgb))
+      else:
+        t = 2 * bayer[(x + j) % 4] + 1 if dither else 16
+        r, g, b = ((32 * (LEVELS - 1) * v + 255 * t) // 8160 for v in rgb)
+        pixel_row.append(SET | r << 10 | g << 5 | b)
+    quantized.append(pixel_row)
+  return quantized
 
 
 class DisplayServer():
 
   def __init__(self):
+    # the half and braille glyphs need the locale's encoding
+    locale.setlocale(locale.LC_ALL, '')
     self.screen = curses.initscr()
     # no visible cursor
     curses.curs_set(0)
     # no input echoing
     curses.noecho()
-    # init color
+    # init color, colors and pairs being defined as they are drawn (see
+    # ColorPairs), pair 0 cannot be changed
     curses.start_color()
-    # init r,g,b colors
-    color_num = 0 # ranges from 0 to 216 (>256)
-    color_range_step = 1000 // 5
-    # r,g,b each range 0 to 1000 in curses module
-    for b in range(0, 1001, color_range_step):
-      for g in range(0, 1001, color_range_step):
-        for r in range(0, 1001, color_range_step):
-          curses.init_color(color_num, r, g, b)
-          color_num += 1
-    # init color pairs (use black background)
-    for color in range(0, color_num):
-      curses.init_pair(color, color, 0)
+    ncolors = min(curses.COLORS, LEVELS**3)
+    npairs = min(curses.COLOR_PAIRS, 256) - 1
+    if curses.can_change_color():
+      curses.init_color(0, 0, 0, 0)
+      color_pairs.reset(ncolors - 1, npairs)
+    else:
+      color_pairs.reset(0, npairs, [(color,) + terminal_color(color) for color in range(1, min(ncolors, 256))])
     # init pixel buffers
     maxy, maxx = self.screen.getmaxyx()
     self.pixel_buffers = [PixelBuffer(maxy, maxx)]
     #self.pixel_buffers[0].buffer.replace(self.screen)
-    curses.panel.update_panels()
-    curses.doupdate()
+    self.flush()
 
   def end(self):
     self.clear_screen(remove_all_buffers=True)
@@ -41,54 +447,157 @@ class DisplayServer():
     curses.nocbreak()
     curses.endwin()
 
+  def flush(self):
+    """Draw what changed in the pixel buffers as one frame, in one doupdate
+
+    Panels are gone through from the top down, and each buffer leaves out
+    the cells under the panels shown above it, as well as all of its cells
+    while hidden.  Those stay marked and are drawn once they show.  When
+    drawing took colors from cells drawn before, needed more than the
+    terminal holds, or would fit with more levels of colors, all cells are
+    drawn again in the frame, the latter two with colors of fewer or more
+    levels (see ColorPairs).  Returns the rectangles drawn on the screen,
+    merged where they overlap.
+    """
+    color_pairs.next_frame()
+    drawn = self._draw()
+    again = color_pairs.evicted or (not color_pairs.overflowed and color_pairs.refine())
+    while (color_pairs.overflowed and color_pairs.coarsen()) or again:
+      again = False
+      color_pairs.next_frame(redraw=True)
+      for pb in self.pixel_buffers:
+        pb.touch()
+      drawn.extend(self._draw())
+    self.screen.noutrefresh()
+    curses.panel.update_panels()
+    curses.doupdate()
+    return merge_rects(drawn)
+
+  def _draw(self):
+    # draw the pixel buffers in their windows, returning the rectangles
+    # drawn
+    buffers = {id(pb.buffer): pb for pb in self.pixel_buffers if pb.buffer is not None}
+    drawn = []
+    above = []
+    panel = curses.panel.top_panel()
+    while panel is not None:
+      if not panel.hidden():
+        top, left = panel.window().getbegyx()
+        nlines, ncols = panel.window().getmaxyx()
+        if id(panel) in buffers:
+          hidden = [(t - top, l - left, b - top, r - left) for t, l, b, r in above]
+          drawn.extend((t + top, l + left, b + top, r + left) for t, l, b, r in buffers[id(panel)].flush(hidden))
+        above.append((top, left, top + nlines, left + ncols))
+      panel = panel.below()
+    return drawn
+
+  def show_image(self, y, x, image, colors=256):
+    # draw an image in sixels with its upper left corner at cell y, x, over
+    # the screen until curses draws those cells again; image is as for
+    # sixel.encode
+    self.flush()
+    # curses keeps track of the cursor, so put it back where it was
+    os.write(sys.stdout.fileno(), b'\0337\033[%d;%dH' % (y + 1, x + 1) + sixel.encode(image, colors) + b'\0338')
+
+  def run(self, update, fps=30):
+    # call update with the frame number and draw what it changed, fps
+    # frames a second, until it returns False
+    period = 1 / fps
+    frame = 0
+    next_frame = time.monotonic()
+    while update(frame) is not False:
+      self.flush()
+      frame += 1
+      next_frame += period
+      delay = next_frame - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+      else:
+        # running late, so start counting again instead of rushing frames
+        next_frame = time.monotonic()
+
   def pause(self):
-    self.screen.refresh()
+    self.flush()
     self.screen.getch()
 
   def clear_screen(self, remove_all_buffers=False):
+    color_pairs.clear()
     for pb in self.pixel_buffers:
       pb.clear(delete=remove_all_buffers)
     if remove_all_buffers:
       self.pixel_buffers = []
 
-  def new_pixel_buffer(self, nlines=1, ncols=1, begin_y=0, begin_x=0):
-    pixel_buffer = PixelBuffer(nlines, ncols, begin_y, begin_x)
+  def new_pixel_buffer(self, nlines=1, ncols=1, begin_y=0, begin_x=0, mode='cell'):
+    pixel_buffer = PixelBuffer(nlines, ncols, begin_y, begin_x, mode)
     self.pixel_buffers.append(pixel_buffer)
     return pixel_buffer
 
 
 
 class PixelBuffer():
-  """Buffer of pixels that can be shown and hidden, plus moved around"""
+  """Buffer of pixels that can be shown and hidden, plus moved around
 
-  def __init__(self, nlines=1, ncols=1, begin_y=0, begin_x=0):
+  Pixels are kept in a shadow framebuffer, each holding its color, SET
+  and BLINK, 0 for no pixel.  Reads come from there, writes go there and
+  mark the span of each row of cells they changed, and flush draws only
+  those spans in curses.  The mode sets how many pixels a cell shows: one
+  '@' in 'cell' mode, two lines of half blocks in 'half' mode and 4 lines
+  by 2 columns of braille dots in 'braille' mode.
+  """
+
+  def __init__(self, nlines=1, ncols=1, begin_y=0, begin_x=0, mode='cell'):
     self.buffer = curses.panel.new_panel(curses.newwin(nlines, ncols, begin_y, begin_x))
+    self.nlines = nlines
+    self.ncols = ncols
+    self.mode = mode
+    sub_h, sub_w = MODES[mode]
+    self.pixel_lines = nlines * sub_h
+    self.pixel_cols = ncols * sub_w
+    self.pixels = array('I', bytes(4 * self.pixel_lines * self.pixel_cols))
+    # row -> [first, one past the last] column of cells changed since the
+    # last flush
+    self.dirty = {}
     self.buffer.top()
     self.buffer.show()
-    curses.panel.update_panels()
-    curses.doupdate()
 
   def clear(self, delete=False):
     self.buffer.window().clear()
+    self.pixels = array('I', bytes(4 * self.pixel_lines * self.pixel_cols))
+    self.dirty = {}
     if delete:
       self.buffer = None
       del self
 
+  def touch(self):
+    # mark all cells, to be drawn again
+    self.dirty = {y: [0, self.ncols] for y in range(0, self.nlines)}
+
+  def _mark(self, y, lo, hi):
+    # mark the cells of pixels lo to hi on line y
+    sub_h, sub_w = MODES[self.mode]
+    y, lo, hi = y // sub_h, lo // sub_w, (hi + sub_w - 1) // sub_w
+    if y in self.dirty:
+      span = self.dirty[y]
+      span[0] = min(span[0], lo)
+      span[1] = max(span[1], hi)
+    else:
+      self.dirty[y] = [lo, hi]
+
   def set_pixel(self, y=0, x=0, rgb=(0,0,0), set_blink=False):
-    # y, x relative to upper left corner of buffer
+    # y, x relative to upper left corner of buffer, in pixels
     # Test if coordinates are right
-    if not self.buffer.window().enclose(y, x):
+    if not (0 <= y < self.pixel_lines and 0 <= x < self.pixel_cols):
       return
-    # rgb - arithmetic, each range from 0 to 6
-    r, g, b = rgb
-    color_num = b
-    color_num += 6*g
-    color_num += 36*r
-    cp = color_num
+    # rgb - arithmetic, each range from 0 to 5
+    pixel = SET | pixel_color(rgb)
     # maybe set blink
-    if_set_blink = curses.A_BLINK if set_blink else 0x0
-    # set pixel
-    self.buffer.window().addch(y, x, '@', curses.color_pair(cp) | if_set_blink)
+    if set_blink:
+      pixel |= BLINK
+    # set pixel, drawn on flush
+    i = y * self.pixel_cols + x
+    if self.pixels[i] != pixel:
+      self.pixels[i] = pixel
+      self._mark(y, x, x + 1)
 
   def set_sixel(self, y=0, x=0, rgb=(0,0,0), repeat=1, ch='~'):
     # get binary bitmask of sixel
@@ -102,22 +611,78 @@ class PixelBuffer():
       for j in y_range:
         self.set_pixel(y+j, x+i, rgb)
 
-  def get_pixel(self, y, x):
-    # y, x are relative to upper left corner of buffer
-    char_and_attr = self.buffer.window().inch(y, x)
-    is_blinking = (char_and_attr & curses.A_ATTRIBUTES) == curses.A_BLINK
-    color_pair = char_and_attr & curses.A_COLOR
-    fg_color, _ = curses.pair_content(color_pair)
-    rgb = curses.color_content(fg_color) # rgb is a 3-tuple ranging from 0 to 1000
-    r, g, b = rgb
-    r *= 5
-    g *= 5
-    b *= 5
-    r //= 1000
-    g //= 1000
-    b //= 1000
-    return (is_blinking, (r, g, b))
+  def blit(self, pixels, y=0, x=0, levels=False, dither=False, set_blink=False):
+    """Set rows of r, g, b pixels with their upper left corner at y, x
+
+    pixels is a height x width x 3 numpy array, or nested sequences, of
+    bytes or, with levels set, of levels from 0 to 5 as for set_pixel.
+    Pixels off the buffer are left out, the rest are quantized in one go
+    (see quantize) and only the span of each row that changed is marked.
+    """
+    # clip to the buffer before quantizing
+    top, left = max(0, -y), max(0, -x)
+    pixels = pixels[top:max(top, self.pixel_lines - y)]
+    if numpy is not None and isinstance(pixels, numpy.ndarray):
+      pixels = pixels[:, left:max(left, self.pixel_cols - x)]
+    else:
+      pixels = [row[left:max(left, self.pixel_cols - x)] for row in pixels]
+    y += top
+    x += left
+    flag = BLINK if set_blink else 0
+    quantized = quantize(pixels, y, x, levels, dither)
+    if numpy is not None and isinstance(quantized, numpy.ndarray):
+      quantized = (quantized | flag).astype(numpy.uint32)
+      rows = (array('I', row.tobytes()) for row in quantized)
+    else:
+      rows = (array('I', [pixel | flag for pixel in row]) for row in quantized)
+    for i, row in enumerate(rows):
+      start = (y + i) * self.pixel_cols + x
+      span = changed_span(self.pixels[start:start + len(row)], row)
+      if span is not None:
+        self.pixels[start:start + len(row)] = row
+        self._mark(y + i, x + span[0], x + span[1])
+
+  def flush(self, hidden=()):
+    # draw the spans changed since the last flush, each run of cells of the
+    # same colors with a single addstr, leaving out and keeping marked the cells under
+    # the (top, left, bottom, right) rectangles of hidden; returns the
+    # rectangles drawn
+    window = self.buffer.window()
+    sub_h, sub_w = MODES[self.mode]
+    drawn = []
+    dirty = {}
+    for y, (lo, hi) in self.dirty.items():
+      cuts = [(left, right) for top, left, bottom, right in hidden if top <= y < bottom]
+      pieces = subtract_spans(lo, hi, cuts)
+      if pieces != [(lo, hi)]:
+        under = subtract_spans(lo, hi, pieces)
+        dirty[y] = [under[0][0], under[-1][1]]
+      for piece_lo, piece_hi in pieces:
+        starts = [(y * sub_h + i) * self.pixel_cols + piece_lo * sub_w for i in range(0, sub_h)]
+        x = piece_lo
+        for text, length, fg, bg, blink in pack([self.pixels[start:start + (piece_hi - piece_lo) * sub_w] for start in starts], self.mode):
+          # no pixel is left as it is
+          if text is not None:
+            cp = color_pairs.pair(fg, bg)
+            attr = curses.color_pair(cp) | (curses.A_BLINK if blink else 0x0)
+            try:
+              window.addstr(y, x, text, attr)
+            except curses.error:
+              # the lower right corner is drawn, only the cursor cannot move on
+              pass
+          x += length
+        drawn.append((y, piece_lo, y + 1, piece_hi))
+    self.dirty = dirty
+    return drawn
 
+  def get_pixel(self, y, x):
+    # y, x are relative to upper left corner of buffer, in pixels
+    # (0, 0, 0) where no pixel is set
+    if not (0 <= y < self.pixel_lines and 0 <= x < self.pixel_cols):
+      raise IndexError('pixel out of buffer')
+    pixel = self.pixels[y * self.pixel_cols + x]
+    is_blinking = (pixel & BLINK) != 0
+    return (is_blinking, color_levels(pixel & COLOR))
 
 
 
@@ -158,9 +723,9 @@ if __name__ == '__main__':
 
   for i in range(0,16):
     for j in range(0,16):
-      r = random.randrange(7)
-      g = random.randrange(7)
-      b = random.randrange(7)
+      r = random.randrange(6)
+      g = random.randrange(6)
+      b = random.randrange(6)
       blnk = random.choice([True,False,False,False,False,False,False,False,False,False])
       pb0.set_pixel(i, j, (r,g,b), blnk)
 
@@ -185,6 +750,40 @@ if __name__ == '__main__':
 
   ds.pause()
 
+  # a gradient over the whole buffer, dithered
+  gradient = [[(255*j//pbmaxx, 255*i//pbmaxy, 128) for j in range(0, pbmaxx)] for i in range(0, pbmaxy)]
+  if numpy is not None:
+    gradient = numpy.array(gradient, dtype=numpy.uint8)
+  pb0.blit(gradient, dither=True)
+
+  ds.pause()
+
+  # the gradient at 2 and at 8 pixels a cell
+  for k, mode in enumerate(('half', 'braille')):
+    fine = ds.new_pixel_buffer(8, 30, 2 + 10*k, 40, mode)
+    gradient = [[(255*j//fine.pixel_cols, 255*i//fine.pixel_lines, 128) for j in range(0, fine.pixel_cols)] for i in range(0, fine.pixel_lines)]
+    fine.blit(gradient if numpy is None else numpy.array(gradient, dtype=numpy.uint8), dither=True)
+
+  ds.pause()
+
+  # the gradient again in true sixels, 6 pixels a line of cells
+  gradient = [[(255*j//240, 255*i//96, 128) for j in range(0, 240)] for i in range(0, 96)]
+  ds.show_image(2, 2, gradient if numpy is None else numpy.array(gradient, dtype=numpy.uint8))
+
+  ds.pause()
+
+  # overlapping buffers sliding across each other, 30 frames a second
+  boxes = [ds.new_pixel_buffer(6, 12, 2 + 3*k, 0) for k in range(0, 3)]
+  for k, box in enumerate(boxes):
+    box.blit([[(5*(k == 0), 5*(k == 1), 5*(k == 2))] * 12] * 6, levels=True)
+  def slide(frame):
+    for k, box in enumerate(boxes):
+      box.buffer.move(2 + 3*k, frame * (k+1) % (pbmaxx - 12))
+    return frame < 90
+  ds.run(slide, fps=30)
+
+  ds.pause()
+
   ds.clear_screen(remove_all_buffers=False)
 
   ds.pause()
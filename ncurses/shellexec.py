@@ -2,37 +2,664 @@
 
 import curses
 import curses.ascii
+import heapq
+import itertools
+import json
+import math
+import mmap
 import os
+import queue
 import sys
 import socket
+import subprocess
+import tempfile
+import threading
+import time
 
+from array import array
+from bisect import bisect_left, bisect_right
 
-executables = os.listdir('/usr/sbin')
-for cmd in os.listdir('/usr/bin'):
-  executables.append(cmd)
-for cmd in os.listdir('/usr/local/sbin'):
-  executables.append(cmd)
-for cmd in os.listdir('/usr/local/bin'):
-  executables.append(cmd)
 
+# executables of each directory, cached with the mtime of the directory
+CACHE_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'shellexec', 'executables.json')
+# commands run, one a line, oldest first
+HISTORY_FILE = os.path.join(os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share'), 'shellexec', 'history')
+# a use of a command counts half as much this many commands later
+HALF_LIFE = 100
 
 
-def main(stdscr):
+def path_dirs():
+  # directories of $PATH in search order, each once
+  dirs = []
+  for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+    if d and d not in dirs:
+      dirs.append(d)
+  return dirs
+
+
+def load_cache():
+  # directory -> [mtime in ns, executable names]
+  try:
+    with open(CACHE_FILE) as f:
+      cache = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  return cache if isinstance(cache, dict) else {}
+
+
+def save_cache(cache):
+  # write to a temporary file first, so a crash never leaves half a cache
+  try:
+    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(CACHE_FILE))
+    with os.fdopen(fd, 'w') as f:
+      json.dump(cache, f)
+    os.replace(temp_name, CACHE_FILE)
+  except OSError:
+    pass
+
+
+def list_executables(d):
+  # names of the executable files in a directory
+  names = []
+  try:
+    with os.scandir(d) as entries:
+      for entry in entries:
+        try:
+          if entry.is_file() and os.access(entry.path, os.X_OK):
+            names.append(entry.name)
+        except OSError:
+          pass
+  except OSError:
+    pass
+  return names
+
+
+def cached_executables(cache):
+  # executables of $PATH as cached, without touching the directories
+  return [name for d in path_dirs() if d in cache for name in cache[d][1]]
+
+
+# directory -> (mtime in ns, names, names not starting with '.', names of
+# the subdirectories), kept between keystrokes so a directory is only
+# listed again once it changed
+listings = {}
+
+
+def list_dir(d):
+  # names in a directory, sorted, as listed last unless it changed since
+  d = os.path.abspath(d)
+  try:
+    mtime = os.stat(d).st_mtime_ns
+  except OSError:
+    return ([], [], frozenset())
+  if d not in listings or listings[d][0] != mtime:
+    names = []
+    dirs = set()
+    try:
+      with os.scandir(d) as entries:
+        for entry in entries:
+          names.append(entry.name)
+          try:
+            if entry.is_dir():
+              dirs.add(entry.name)
+          except OSError:
+            pass
+    except OSError:
+      pass
+    names.sort()
+    listings[d] = (mtime, names, [name for name in names if not name.startswith('.')], dirs)
+  return listings[d][1:]
+
+
+def arg_completions(word):
+  # (part of word kept, names that can follow it, which of them are
+  # directories) for an argument: an environment variable after '$',
+  # otherwise a path
+  if word.startswith('$') and '/' not in word:
+    return ('$', sorted(name for name in os.environ if name.startswith(word[1:])), frozenset())
+  head = word[:word.rfind('/')+1]
+  base = word[len(head):]
+  names, visible, dirs = list_dir(os.path.expanduser(os.path.expandvars(head)) if head else '.')
+  # hidden names only once a '.' is typed
+  if not base.startswith('.'):
+    names = visible
+  # the names starting with base sit together in sorted order
+  lo = bisect_left(names, base)
+  hi = bisect_left(names, base + '\U0010ffff', lo)
+  return (head, names[lo:hi], dirs)
+
+
+class History():
+  """Commands run, kept in an append-only log with an index of where each starts
+
+  The log is memory-mapped and entries are only decoded when asked for.
+  The index is a file of 8-byte offsets, appended to along with the log,
+  so opening a history of any length reads no more than the index.
+  Commands logged without the index, such as by an older shellexec, are
+  indexed when opened.
+  """
+
+  # only this many of the latest commands weigh in on frecency
+  RECENT = 20 * HALF_LIFE
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.offsets = array('Q')
+    self.data = b''
+    try:
+      os.makedirs(os.path.dirname(filename), exist_ok=True)
+      self.log = os.open(filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+      self.index = os.open(filename + '.idx', os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+    except OSError:
+      self.log = None
+      return
+    size = os.fstat(self.log).st_size
+    if size > 0:
+      self.data = mmap.mmap(self.log, size, access=mmap.ACCESS_READ)
+    with open(self.index, 'rb', closefd=False) as f:
+      self.offsets.frombytes(f.read(os.fstat(self.index).st_size // 8 * 8))
+    # an index running past the log, or not at line starts, is rebuilt
+    if len(self.offsets) > 0 and (self.offsets[-1] >= size or (self.offsets[-1] > 0 and self.data[self.offsets[-1]-1] != 10)):
+      self.offsets = array('Q')
+      os.ftruncate(self.index, 0)
+    # two shellexecs appending at once may index out of order
+    if any(b <= a for a, b in zip(self.offsets, itertools.islice(self.offsets, 1, None))):
+      self.offsets = array('Q', sorted(set(self.offsets)))
+      os.ftruncate(self.index, 0)
+      os.write(self.index, self.offsets.tobytes())
+    # index what was logged after the last command indexed
+    pos = 0
+    if len(self.offsets) > 0:
+      pos = self.data.find(b'\n', self.offsets[-1]) + 1 or size
+    tail = array('Q')
+    while pos < size:
+      tail.append(pos)
+      pos = self.data.find(b'\n', pos) + 1 or size
+    if len(tail) > 0:
+      os.write(self.index, tail.tobytes())
+      self.offsets.extend(tail)
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, n):
+    start = self.offsets[n]
+    end = self.data.find(b'\n', start)
+    if end < 0:
+      end = len(self.data)
+    return self.data[start:end].decode('utf-8', 'surrogateescape')
+
+  def append(self, cmd):
+    if self.log is None:
+      return
+    line = cmd.encode('utf-8', 'surrogateescape') + b'\n'
+    os.write(self.log, line)
+    # the log may have been appended to by another shellexec meanwhile
+    end = os.lseek(self.log, 0, os.SEEK_CUR)
+    offset = array('Q', [end - len(line)])
+    os.write(self.index, offset.tobytes())
+    self.offsets.extend(offset)
+    # map the log again with what was appended, letting go of the old map
+    if len(self.data) > 0:
+      self.data.close()
+    self.data = mmap.mmap(self.log, 0, access=mmap.ACCESS_READ)
+
+  def search_back(self, text, before):
+    # latest entry before entry number before holding text, None for none
+    if before <= 0 or len(text) == 0:
+      return None
+    end = self.offsets[before] if before < len(self.offsets) else len(self.data)
+    found = self.data.rfind(text.encode('utf-8', 'surrogateescape'), 0, end)
+    if found < 0:
+      return None
+    return bisect_right(self.offsets, found) - 1
+
+  def frecency(self):
+    # command name -> uses of it lately, recent uses weighing more
+    frecency = {}
+    for age in range(0, min(len(self), self.RECENT)):
+      words = self[len(self) - 1 - age].split()
+      if len(words) > 0:
+        frecency[words[0]] = frecency.get(words[0], 0) + 0.5 ** (age / HALF_LIFE)
+    return frecency
+
+
+# characters that need a shell to mean what they say
+SHELL_CHARS = frozenset('|&;<>()$`\\"\'*?[]#~=%{}!\n')
+
+
+def command_argv(cmd):
+  # run simple commands directly, only handing shell syntax to /bin/sh
+  if SHELL_CHARS.isdisjoint(cmd):
+    return cmd.split()
+  return ['/bin/sh', '-c', cmd]
+
+
+class Job():
+  """Command run in loop mode, with its exit status and wall time once done"""
+
+  def __init__(self, number, cmd):
+    self.number = number
+    self.cmd = cmd
+    self.proc = None
+    self.start = time.monotonic()
+    self.status = None
+    self.wall = None
+
+
+class JobPane():
+  """Output of the commands run in loop mode, streamed into the bottom rows
+
+  Every command is a job of its own, so several can run at once.  A thread
+  per job reads its output into a queue, which the prompt drains while it
+  waits for keys.
+  """
+
+  # most lines shown at once, so a flood of output leaves keys answered
+  SHOW_LINES = 500
+
+  def __init__(self, stdscr, top):
+    maxy, maxx = stdscr.getmaxyx()
+    # row of the line above the output
+    self.top = top
+    stdscr.hline(top, 0, '-', maxx)
+    self.win = stdscr.derwin(maxy - top - 1, maxx, top + 1, 0)
+    self.win.scrollok(True)
+    self.output = queue.Queue()
+    self.jobs = []
+
+  def run(self, cmd):
+    job = Job(len(self.jobs) + 1, cmd)
+    self.jobs.append(job)
+    try:
+      job.proc = subprocess.Popen(command_argv(cmd), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+      job.status = 127
+      job.wall = time.monotonic() - job.start
+      self.output.put('[' + str(job.number) + '] ' + cmd.split()[0] + ': ' + e.strerror)
+      return job
+    threading.Thread(target=self._read, args=(job,), daemon=True).start()
+    return job
+
+  def _read(self, job):
+    for line in job.proc.stdout:
+      self.output.put('[' + str(job.number) + '] ' + line.decode('utf-8', 'replace').rstrip('\n').replace('\0', ''))
+    job.status = job.proc.wait()
+    job.wall = time.monotonic() - job.start
+    self.output.put(self._describe(job))
+
+  def _describe(self, job):
+    if job.status is None:
+      state = 'running %.2fs' % (time.monotonic() - job.start)
+    else:
+      state = 'exit %d in %.2fs' % (job.status, job.wall)
+    return '[' + str(job.number) + '] ' + state + ': ' + job.cmd
+
+  def list_jobs(self):
+    for job in self.jobs:
+      self.output.put(self._describe(job))
+
+  def stop(self):
+    for job in self.jobs:
+      if job.status is None and job.proc is not None:
+        job.proc.terminate()
+
+  def show(self):
+    # write out the lines read meanwhile, returning True if there were any
+    shown = 0
+    while shown < self.SHOW_LINES:
+      try:
+        line = self.output.get_nowait()
+      except queue.Empty:
+        break
+      self.win.addstr(line + '\n')
+      shown += 1
+    if shown > 0:
+      self.win.noutrefresh()
+    return shown > 0
+
+
+def discover(cache, frecency):
+  # rescan the directories of $PATH changed since they were cached, then
+  # swap in an index of the new executables
+  global index
+  fresh = {}
+  for d in path_dirs():
+    try:
+      mtime = os.stat(d).st_mtime_ns
+    except OSError:
+      continue
+    if d in cache and cache[d][0] == mtime:
+      fresh[d] = cache[d]
+    else:
+      fresh[d] = [mtime, list_executables(d)]
+  if fresh == {d: cache[d] for d in path_dirs() if d in cache}:
+    return
+  cache = dict(cache)
+  cache.update(fresh)
+  save_cache(cache)
+  index = CompletionIndex((name for d in fresh for name in fresh[d][1]), frecency)
+
+
+def match_end(name, query):
+  # one past where the characters of query first match in order in name,
+  # 0 if they do not
+  end = 0
+  for c in query:
+    end = name.find(c, end) + 1
+    if end == 0:
+      return 0
+  return end
+
+
+class Walk():
+  """How far ranking got walking the names holding the characters of a query
+
+  found are the (least score, id, where the match ends) of the names found
+  matching the query, in the order of by_char.  The walk goes on with the
+  sources, each [found matching fewer characters, how many of them are
+  taken, the characters they lack], and then with the rest of by_char,
+  from walked on.
+  """
+
+  def __init__(self, parent=None, c=''):
+    # the walk of the query without its last character c
+    self.found = []
+    self.sources = []
+    self.walked = 0
+    if parent is not None:
+      self.sources = [[parent.found, 0, c]] + [[found, taken, lacking + c] for found, taken, lacking in parent.sources if taken < len(found)]
+      self.walked = parent.walked
+
+
+class CompletionIndex():
+  """Command names ranked by how well they fuzzily match what is typed
+
+  A name matches if it holds the typed characters in order, ignoring
+  case.  The score adds up the gaps between the matched characters, how
+  far in the match starts and the length of the name, less a bonus for
+  names used often and lately.  For each character the names holding it
+  are kept sorted by the least score any query starting with it can give,
+  so ranking walks that list only until no name left can beat the best
+  ones found, taking them off a heap as they are needed, and past SCORED
+  names taking the rest to score the least they can.  The names holding
+  every character typed so far, as many times as typed, are kept on a
+  stack, so one more character intersects one more set and deleting one
+  pops back.  Along with them go the names matching and where each match
+  ends, all of them once they are few, else as far as the walk got (see
+  Walk), so one more character only goes on from there.  A search can be
+  given a budget of names to look at, past which it is cut short, to go
+  on from there when searched again.
+  """
+
+  # names matched one by one instead of walking the least score order
+  DIRECT = 256
+  # names scored at most walking the least score order
+  SCORED = 128
+  # names looked at in a search for completions to show
+  BUDGET = 256
+
+  def __init__(self, names, frecency=None):
+    if frecency is None:
+      frecency = {}
+    self.names = sorted(set(names))
+    self.lower = [name.lower() for name in self.names]
+    # less is better, so names used often and lately get a bonus off
+    self.bonus = [int(8 * math.log2(1 + frecency.get(name, 0))) for name in self.names]
+    self.base = [len(name) - bonus for name, bonus in zip(self.names, self.bonus)]
+    # character -> (least score, id) of the names holding it, in order
+    self.by_char = {}
+    for i, name in enumerate(self.lower):
+      for c in set(name):
+        if c not in self.by_char:
+          self.by_char[c] = []
+        self.by_char[c].append((2 * name.find(c) + self.base[i], i))
+    for entries in self.by_char.values():
+      entries.sort()
+    # ids in the order of by_char, for picking out the names still matching
+    self.by_char_ids = {c: [i for _, i in entries] for c, entries in self.by_char.items()}
+    # character repeated n times -> ids of the names holding it n times
+    self.holding = {}
+    for i, name in enumerate(self.lower):
+      for c in set(name):
+        for n in range(1, name.count(c) + 1):
+          self.holding.setdefault(c * n, set()).add(i)
+    # with nothing typed, names go by their bonus
+    self.by_bonus = sorted(range(0, len(self.names)), key=lambda i: -self.bonus[i])
+    # (query, ids of the names holding all of its characters, id -> where
+    # the match ends of those matching it if DIRECT at most, else its Walk)
+    # for each query typed
+    self.stack = [('', None, None, None)]
+    # whether the last search ran out of budget
+    self.cut_short = False
+
+  def _holding(self, query):
+    # (ids, ends, walk) of query as kept on the stack
+    # go back to the longest query typed that this one goes on from
+    while not query.startswith(self.stack[-1][0]):
+      self.stack.pop()
+    last, ids, ends, walk = self.stack[-1]
+    for c in query[len(last):]:
+      last += c
+      c = c.lower()
+      if ends is not None:
+        # only names matching one character less can match
+        ends = {i: end + 1 for i, end in ((i, self.lower[i].find(c, end)) for i, end in ends.items()) if end >= 0}
+        ids = ends.keys()
+      else:
+        c_ids = self.holding.get(c * last.lower().count(c), set())
+        ids = c_ids if ids is None else ids & c_ids
+        if len(ids) <= self.DIRECT:
+          lower = last.lower()
+          ends = {i: end for i, end in ((i, match_end(self.lower[i], lower)) for i in ids) if end > 0}
+          walk = None
+        else:
+          walk = Walk(walk, c)
+      self.stack.append((last, ids, ends, walk))
+    return ids, ends, walk
+
+  def _walk(self, query, ids, walk, budget):
+    # yield (least score, id, where the match ends) of the names matching
+    # query in the order of by_char, looking at no more than budget names
+    # past those found before
+    found = walk.found
+    n = 0
+    while n < len(found):
+      yield found[n]
+      n += 1
+    for source in walk.sources:
+      names, _, lacking = source
+      while source[1] < len(names):
+        if budget == 0:
+          self.cut_short = True
+          return
+        budget -= 1
+        least, i, end = names[source[1]]
+        source[1] += 1
+        for c in lacking:
+          end = self.lower[i].find(c, end) + 1
+          if end == 0:
+            break
+        if end > 0:
+          found.append((least, i, end))
+          yield (least, i, end)
+    entries = self.by_char[query[0]]
+    # the names still holding the characters, picked out without a python loop
+    for pos in itertools.compress(itertools.count(walk.walked), map(ids.__contains__, itertools.islice(self.by_char_ids[query[0]], walk.walked, None))):
+      if budget == 0:
+        self.cut_short = True
+        return
+      budget -= 1
+      least, i = entries[pos]
+      walk.walked = pos + 1
+      end = match_end(self.lower[i], query)
+      if end > 0:
+        found.append((least, i, end))
+        yield (least, i, end)
+    walk.walked = len(entries)
+
+  def search(self, query, budget=None):
+    # yield the names matching query, best first, looking at no more than
+    # budget names past those found before, None for no end
+    self.cut_short = False
+    if len(query) == 0:
+      for i in self.by_bonus:
+        yield self.names[i]
+      return
+    ids, ends, walk = self._holding(query)
+    query = query.lower()
+    # 4 * gaps + 2 * start + length - bonus, gaps being end - start - len(query),
+    # so 4 * end - least + 2 * base less this
+    typed = 4 * len(query)
+    base = self.base
+    if ends is not None:
+      lower = self.lower
+      heap = [(4 * end - 2 * lower[i].find(query[0]) + base[i] - typed, i) for i, end in ends.items()]
+      heapq.heapify(heap)
+    else:
+      heap = []
+      scored = 0
+      for least, i, end in self._walk(query, ids, walk, math.inf if budget is None else budget):
+        # nothing after this can score under least
+        while len(heap) > 0 and heap[0] < (least, i):
+          yield self.names[heapq.heappop(heap)[1]]
+        if scored == self.SCORED:
+          yield self.names[i]
+        else:
+          scored += 1
+          heapq.heappush(heap, (4 * end - least + 2 * base[i] - typed, i))
+    while len(heap) > 0:
+      yield self.names[heapq.heappop(heap)[1]]
+
+
+index = CompletionIndex(())
+# rows of completions on screen, drawn from row 2 down
+shown_rows = []
+# JobPane in loop mode, None otherwise
+pane = None
+
+
+
+def main(stdscr, history, loop=False):
+  global index, pane
+
+  # complete from the cache at once, while $PATH is rescanned
+  cache = load_cache()
+  frecency = history.frecency()
+  index = CompletionIndex(cached_executables(cache), frecency)
+  threading.Thread(target=discover, args=(cache, frecency), daemon=True).start()
 
   prepend = os.getlogin()+'@'+socket.gethostname()+'$ '
-  stdscr.addstr(0,0,prepend)
+  if not loop:
+    stdscr.addstr(0,0,prepend)
+    return read_cmd(stdscr, history, prepend)
+
+  # run commands as jobs in the bottom half, staying up until 'exit'
+  pane = JobPane(stdscr, stdscr.getmaxyx()[0] // 2)
+  while True:
+    show_line(stdscr, prepend)
+    clear_cmd_display(stdscr)
+    cmd = read_cmd(stdscr, history, prepend)
+    words = cmd.split()
+    if len(words) == 0:
+      continue
+    history.append(cmd)
+    if words[0] == 'exit':
+      pane.stop()
+      return ""
+    elif words[0] == 'cd':
+      try:
+        os.chdir(os.path.expanduser(words[1] if len(words) > 1 else '~'))
+      except OSError as e:
+        pane.output.put('cd: ' + e.strerror)
+    elif words[0] == 'jobs':
+      pane.list_jobs()
+    else:
+      pane.run(cmd)
+    pane.show()
+
+
+def read_cmd(stdscr, history, prepend):
   start_cmd_pos = len(prepend)
 
-  chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890!@#$%^&*()-=_+[]\\{}|;\':\",./<>? "
+  chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890!@#$%^&*()-=_+[]\\{}|;\':\",./<>?`~ "
 
   x = 0
   cmd = ""
+  # history entry shown by the arrow keys, len(history) for the line typed
+  recall = len(history)
+  typed = ""
+  # text searched for with Ctrl-R and the entry found, None when not searching
+  searching = None
+  found = None
+  # wake up now and then to show the rescanned executables
+  stdscr.timeout(100)
+  shown_index = index
+  # completions cut short, ranked on while no key is pressed
+  more = False
   char = stdscr.getch()
-  while char != curses.ascii.NL:
-    if chr(char) not in chars and len(cmd) > 0:
+  while char != curses.ascii.NL or searching is not None:
+    if char == -1:
+      if pane is not None and pane.show() and searching is None:
+        stdscr.move(0,len(prepend)+x)
+      if shown_index is not index or more:
+        shown_index = index
+        if len(cmd) > 0 and searching is None:
+          more = update_cmd_display(stdscr, cmd)
+          stdscr.move(0,len(prepend)+x)
+    elif char == curses.ascii.DC2 or (searching is not None and chr(char) in chars):
+      # Ctrl-R searches back for what is typed, again for an older match
+      if searching is None:
+        searching = ""
+        found = None
+      elif char == curses.ascii.DC2:
+        older = history.search_back(searching, len(history) if found is None else found)
+        if older is not None:
+          found = older
+      else:
+        searching += chr(char)
+        # the entry found may still hold the longer text
+        found = history.search_back(searching, len(history) if found is None else found+1)
+      match = history[found] if found is not None else ""
+      show_line(stdscr, "(reverse-i-search)`" + searching + "': " + match)
+    elif searching is not None and char in (curses.ascii.BS, curses.ascii.DEL, curses.KEY_BACKSPACE):
+      searching = searching[:-1]
+      match = history[found] if found is not None else ""
+      show_line(stdscr, "(reverse-i-search)`" + searching + "': " + match)
+    elif searching is not None:
+      # any other key takes the match to edit, Enter runs it
+      if found is not None:
+        cmd = history[found]
+      searching = None
+      x = len(cmd)
+      show_line(stdscr, prepend + cmd)
+      more = update_cmd_display(stdscr, cmd)
+      stdscr.move(0,len(prepend)+x)
+      if char == curses.ascii.NL:
+        break
+    elif char == curses.ascii.TAB:
+      cmd = complete(cmd)
+      x = len(cmd)
+      show_line(stdscr, prepend + cmd)
+      more = update_cmd_display(stdscr, cmd)
+      stdscr.move(0,len(prepend)+x)
+    elif char in (curses.KEY_UP, curses.KEY_DOWN):
+      if recall == len(history):
+        typed = cmd
+      if char == curses.KEY_UP:
+        recall = max(0, recall-1)
+      else:
+        recall = min(len(history), recall+1)
+      cmd = history[recall] if recall < len(history) else typed
+      x = len(cmd)
+      show_line(stdscr, prepend + cmd)
+      more = update_cmd_display(stdscr, cmd)
+      stdscr.move(0,len(prepend)+x)
+    elif chr(char) not in chars and len(cmd) > 0:
       x -= 1
       cmd = cmd[:-1]
-      update_cmd_display(stdscr, cmd)
+      more = update_cmd_display(stdscr, cmd)
       stdscr.move(0,len(prepend))
       stdscr.addstr(cmd+' ')
       stdscr.move(0,len(prepend)+x)
@@ -41,43 +668,113 @@ def main(stdscr):
     else:
       cmd += chr(char)
       x += 1
-      update_cmd_display(stdscr, cmd)
+      more = update_cmd_display(stdscr, cmd)
       stdscr.move(0,len(prepend))
       stdscr.addstr(cmd)
+    stdscr.timeout(0 if more and searching is None else 100)
     char = stdscr.getch()
   return cmd
 
 
+def show_line(stdscr, line):
+  # rewrite the top line
+  stdscr.move(0,0)
+  stdscr.clrtoeol()
+  stdscr.addstr(0,0,line[:stdscr.getmaxyx()[1]-1])
+
+
+def clear_cmd_display(stdscr):
+  for y in range(0, len(shown_rows)):
+    stdscr.move(y+2, 0)
+    stdscr.clrtoeol()
+  shown_rows[:] = []
+
+
+# characters that end one word and start the next
+WORD_BREAKS = frozenset(' \t|;&<>()')
+# characters a command name follows
+COMMAND_BREAKS = frozenset('|;&(')
+
+
+def split_word(cmd):
+  # (where the word being typed starts, True if it is a command name)
+  start = len(cmd)
+  while start > 0 and cmd[start-1] not in WORD_BREAKS:
+    start -= 1
+  before = cmd[:start].rstrip(' \t')
+  return start, len(before) == 0 or before[-1] in COMMAND_BREAKS
+
+
+def completions(cmd):
+  # names to show for the word being typed, best first, command names
+  # within the budget of a keystroke
+  start, command = split_word(cmd)
+  word = cmd[start:]
+  if command and '/' not in word:
+    return index.search(word, index.BUDGET)
+  head, names, dirs = arg_completions(word)
+  return (name + '/' if name in dirs else name for name in names)
+
+
+def complete(cmd):
+  # cmd with the word being typed completed as far as it can be
+  start, command = split_word(cmd)
+  word = cmd[start:]
+  if command and '/' not in word:
+    best = next(index.search(word), None)
+    return cmd if best is None else cmd[:start] + best + ' '
+  head, names, dirs = arg_completions(word)
+  if len(names) == 1:
+    return cmd[:start] + head + names[0] + ('/' if names[0] in dirs else ' ')
+  # several names only complete to what they all start with
+  return cmd[:start] + head + os.path.commonprefix(names) if len(names) > 1 else cmd
+
+
 def update_cmd_display(stdscr, cmd):
-  cmds = []
-  # get possible commands
-  for command in executables:
-    if cmd in command:
-      cmds.append(command)
-  # clear cmd display before displaying new commands
-  for y_pos in range(2,stdscr.getmaxyx()[0]):
-    stdscr.hline(y_pos,0,' ',stdscr.getmaxyx()[1]-1)
-  # display commands
-  if len(cmds) > 0:
-    y = 1
+  # True if ranking the command names was cut short, to go on when idle
+  maxy, maxx = stdscr.getmaxyx()
+  # completions stop above the job output in loop mode
+  if pane is not None:
+    maxy = pane.top
+  # lay out the best names a row at a time, ranking only as many as fit
+  searched = index
+  searched.cut_short = False
+  ranked = completions(cmd)
+  name = next(ranked, None)
+  rows = []
+  while len(rows) < maxy - 2 and name is not None:
+    row = []
     x = 0
-    c = 0
-    brk = False
-    while y < (stdscr.getmaxyx()[0] - 1):
-      if brk or c > (len(cmds) - 1):
-        break
-      y += 1
-      x = 0
-      while x < (stdscr.getmaxyx()[1] - len(cmds[c]) - 1):
-        stdscr.addstr(y, x, cmds[c])
-        x += len(cmds[c])+1
-        c += 1
-        if c > (len(cmds) - 1):
-          brk = True
-          break
+    while name is not None and x < (maxx - len(name) - 1):
+      row.append(name)
+      x += len(name)+1
+      name = next(ranked, None)
+    if len(row) == 0:
+      break
+    rows.append(' '.join(row))
+  # only redraw rows that changed
+  for y in range(0, max(len(rows), len(shown_rows))):
+    row = rows[y] if y < len(rows) else ''
+    if y < len(shown_rows) and shown_rows[y] == row:
+      continue
+    stdscr.move(y+2, 0)
+    stdscr.clrtoeol()
+    stdscr.addstr(y+2, 0, row)
+  shown_rows[:] = rows
+  return searched.cut_short
 
 
 
 if __name__ == '__main__':
-  cmd = curses.wrapper(main)
-  os.system(cmd)
+  history = History(HISTORY_FILE)
+  # with --loop, stay up running commands until 'exit'
+  loop = '--loop' in sys.argv[1:]
+  cmd = curses.wrapper(main, history, loop)
+  if not loop and len(cmd.strip()) > 0:
+    history.append(cmd)
+    try:
+      status = subprocess.run(command_argv(cmd)).returncode
+    except OSError as e:
+      print(cmd.split()[0] + ': ' + e.strerror, file=sys.stderr)
+      status = 127
+    sys.exit(status)
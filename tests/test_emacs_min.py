@@ -0,0 +1,135 @@
+import fcntl
+import importlib.util
+import os
+import pty
+import select
+import struct
+import subprocess
+import sys
+import termios
+import time
+
+import pytest
+
+EMACS_MIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ncurses', 'emacs-min.py')
+
+
+class Editor():
+  """emacs-min run on a pseudo-terminal, its output read as it comes"""
+
+  def __init__(self, width=80, height=24):
+    self.master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', height, width, 0, 0))
+    env = dict(os.environ, TERM='xterm', LINES=str(height), COLUMNS=str(width))
+    self.proc = subprocess.Popen([sys.executable, EMACS_MIN], stdin=slave, stdout=slave, stderr=slave, env=env)
+    os.close(slave)
+
+  def read(self, seconds):
+    # output within seconds of nothing more coming
+    out = b''
+    while select.select([self.master], [], [], seconds)[0]:
+      try:
+        data = os.read(self.master, 65536)
+      except OSError:
+        break
+      if len(data) == 0:
+        break
+      out += data
+    return out.decode('utf-8', 'replace')
+
+  def read_until(self, text, seconds=5):
+    # output up to and including text
+    out = ''
+    end = time.time() + seconds
+    while text not in out:
+      assert time.time() < end, 'no ' + repr(text) + ' in ' + repr(out)
+      out += self.read(0.1)
+    return out
+
+  def send(self, keys):
+    os.write(self.master, keys.encode())
+
+  def close(self):
+    self.proc.kill()
+    self.proc.wait()
+    os.close(self.master)
+
+
+@pytest.fixture
+def editor():
+  editor = Editor()
+  editor.read_until('Help buffer')
+  yield editor
+  editor.close()
+
+
+def command(editor, cmd):
+  # run a command from the commandline, as Ctrl-G does
+  editor.send('\x07')
+  editor.read(0.3)
+  editor.send(cmd + '\n')
+
+
+@pytest.mark.parametrize('cmd, keys, message', [
+  ('s', '/[/\n', 'Error: Bad Regex'),
+  ('sa', '/(/\n', 'Error: Bad Regex'),
+  ('sn', '', 'Error: No Search'),
+  ('s', 'no such text\n', 'Not Found'),
+])
+def test_search_message_kept_until_key(editor, cmd, keys, message):
+  command(editor, cmd)
+  if len(keys) > 0:
+    editor.read_until('Search For')
+    editor.send(keys)
+  editor.read_until(message)
+  # the statusline keeps the message while editing, until a key is pressed
+  assert 'Buffer ' not in editor.read(0.5)
+  editor.send('\x06')
+  assert 'Buffer ' in editor.read_until('Buffer ')
+
+
+def load_emacs_min():
+  spec = importlib.util.spec_from_file_location('emacs_min', EMACS_MIN)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+emacs_min = load_emacs_min()
+
+
+def open_fds():
+  return len(os.listdir('/proc/self/fd'))
+
+
+def test_mapped_file_close(tmp_path):
+  path = tmp_path / 'lines.txt'
+  path.write_bytes(b'line\n' * 100000)
+  mapped = emacs_min.MappedFile(str(path))
+  mapped.close()
+  assert mapped.file.closed
+  assert mapped.data.closed
+  assert not mapped.scanner.is_alive()
+
+
+def test_text_lets_go_of_files(tmp_path):
+  path = tmp_path / 'lines.txt'
+  path.write_bytes(b'one\ntwo\r\nthree\n')
+  fds = open_fds()
+  text = emacs_min.TextBuffer()
+  for _ in range(0, 20):
+    text.load(emacs_min.MappedFile(str(path)))
+    text.set_line(1, 'TWO')
+    # saving maps the file saved in place of the one replaced
+    opened = text.source
+    text.save(str(path))
+    assert opened.file.closed and opened.data.closed
+    assert list(text) == ['one', 'TWO', 'three']
+    assert text.source.filename == str(path)
+  assert path.read_bytes() == b'one\nTWO\nthree\n'
+  # loading another file or dropping the text closes the one mapped
+  opened = text.source
+  text.load(emacs_min.MappedFile(str(path)))
+  assert opened.file.closed
+  text.close()
+  assert open_fds() == fds
@@ -0,0 +1,88 @@
+import curses
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ncurses'))
+import pixman
+
+
+@pytest.fixture
+def color_pairs(monkeypatch):
+  # colors and pairs of a terminal of 256 colors, defined nowhere
+  monkeypatch.setattr(curses, 'init_color', lambda *args: None)
+  monkeypatch.setattr(curses, 'init_pair', lambda *args: None)
+  color_pairs = pixman.ColorPairs()
+  color_pairs.reset(255, 255)
+  return color_pairs
+
+
+def flush(color_pairs, cells, damaged=None):
+  # draw cells of (fg, bg) as DisplayServer.flush does, the damaged ones
+  # first if given, returning the pairs drawn
+  color_pairs.next_frame()
+  drawn = [color_pairs.pair(fg, bg) for fg, bg in (cells if damaged is None else damaged)]
+  again = color_pairs.evicted or (not color_pairs.overflowed and color_pairs.refine())
+  while (color_pairs.overflowed and color_pairs.coarsen()) or again:
+    again = False
+    color_pairs.next_frame(redraw=True)
+    drawn = [color_pairs.pair(fg, bg) for fg, bg in cells]
+  return drawn
+
+
+def shown(color_pairs, drawn):
+  # pixel colors of the pairs drawn
+  colors = {entry[0]: entry[2] for entry in color_pairs.pairs.values()}
+  return set(colors[pair] for pair in drawn)
+
+
+def test_overflow_keeps_six_levels(color_pairs):
+  rng = random.Random(1)
+  cells = [(rng.randrange(1, pixman.COLOR + 1), 0) for _ in range(0, 20000)]
+  drawn = flush(color_pairs, cells)
+  assert color_pairs.STEPS[color_pairs.step] == 6
+  assert 0 not in drawn
+  colors = shown(color_pairs, drawn)
+  assert len(colors) > 200
+  assert all(pixman.pixel_color(pixman.color_levels(color)) == color for color in colors if color != 0)
+
+
+def test_overflow_takes_nearest_pairs(color_pairs):
+  rng = random.Random(2)
+  cells = [(rng.randrange(1, pixman.COLOR + 1), rng.randrange(1, pixman.COLOR + 1)) for _ in range(0, 5000)]
+  drawn = flush(color_pairs, cells)
+  assert color_pairs.STEPS[color_pairs.step] == 6
+  assert 0 not in drawn
+  assert len(set(drawn)) == 255
+
+
+def test_refine_once_frames_fit(color_pairs):
+  rng = random.Random(3)
+  flush(color_pairs, [(rng.randrange(1, pixman.COLOR + 1), 0) for _ in range(0, 20000)])
+  assert color_pairs.step > 0
+  gradient = [(v << 10 | v << 5 | v, 0) for v in range(0, pixman.LEVELS)]
+  for _ in range(0, len(color_pairs.STEPS)):
+    drawn = flush(color_pairs, gradient)
+  assert color_pairs.step == 0
+  assert len(shown(color_pairs, drawn)) == pixman.LEVELS
+
+
+def test_refine_waits_after_overflow(color_pairs):
+  rng = random.Random(4)
+  cells = [(rng.randrange(1, pixman.COLOR + 1), 0) for _ in range(0, 20000)]
+  flush(color_pairs, cells)
+  step = color_pairs.step
+  # a frame drawing few cells fits finer, but drawing all does not, so
+  # it is tried less and less often
+  tried = []
+  for n in range(0, 40):
+    frame = color_pairs.frame
+    flush(color_pairs, cells, cells[:10])
+    assert color_pairs.step == step
+    if color_pairs.frame - frame > 1:
+      tried.append(n)
+  gaps = [b - a for a, b in zip(tried, tried[1:])]
+  assert len(gaps) > 2
+  assert gaps == sorted(gaps) and gaps[-1] > gaps[0]
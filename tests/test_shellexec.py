@@ -0,0 +1,83 @@
+import itertools
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ncurses'))
+import shellexec
+
+
+PARTS = ('git', 'lib', 'py', 'x', 'config', 'gnome', 'kde', 'perl', 'ssh', 'apt', 'dpkg', 'systemd', 'update', 'alternatives', 'grub', 'mk', 'fs', 'net', 'ls', 'tar', 'zip')
+
+
+def command_names(n, rng):
+  names = set()
+  while len(names) < n:
+    name = '-'.join(rng.choice(PARTS) for _ in range(0, rng.randint(1, 3)))
+    names.add(name + (str(rng.randint(0, 99)) if rng.random() < 0.3 else ''))
+  return sorted(names)
+
+
+def typing(words):
+  # queries typing each word and deleting it again
+  for word in words:
+    for n in itertools.chain(range(1, len(word) + 1), range(len(word) - 1, 0, -1)):
+      yield word[:n]
+
+
+def ranked(index, query):
+  # names matching query, best first, scored one by one
+  query = query.lower()
+  pattern = re.compile('.*?'.join(map(re.escape, query)))
+  scores = []
+  for i, name in enumerate(index.lower):
+    m = pattern.search(name)
+    if m:
+      scores.append((4 * m.end() - 2 * m.start() - 4 * len(query) + index.base[i], i))
+  return [index.names[i] for _, i in sorted(scores)]
+
+
+def test_search_ranks_names():
+  rng = random.Random(1)
+  names = command_names(3000, rng)
+  index = shellexec.CompletionIndex(names, {name: rng.random() * 5 for name in rng.sample(names, 100)})
+  # every name scored, for ranking to be exact
+  index.SCORED = len(names)
+  for query in typing(rng.sample(names, 40) + ['Tar-LS', 'qqq']):
+    # searches cut short go on from where they stopped
+    list(itertools.islice(index.search(query, index.BUDGET), 40))
+    if rng.random() < 0.3:
+      assert list(index.search(query)) == ranked(index, query)
+
+
+def test_search_within_budget():
+  rng = random.Random(2)
+  names = command_names(10000, rng)
+  index = shellexec.CompletionIndex(names, {name: rng.random() * 5 for name in rng.sample(names, 300)})
+  times = []
+  for query in typing(rng.sample(names, 200)):
+    start = time.perf_counter()
+    shown = list(itertools.islice(index.search(query, index.BUDGET), 60))
+    times.append(time.perf_counter() - start)
+    # ranking goes on while idle, until it is done
+    while index.cut_short:
+      shown = list(itertools.islice(index.search(query, index.BUDGET), 60))
+    assert shown == list(itertools.islice(index.search(query), 60))
+  times.sort()
+  assert times[len(times) * 99 // 100] < 0.001
+
+
+def test_history_append_keeps_one_map(tmp_path):
+  history = shellexec.History(str(tmp_path / 'history'))
+  history.append('ls')
+  fds = len(os.listdir('/proc/self/fd'))
+  for n in range(0, 50):
+    mapped = history.data
+    history.append('echo ' + str(n))
+    assert mapped.closed
+  assert len(os.listdir('/proc/self/fd')) == fds
+  assert len(history) == 51
+  assert history[0] == 'ls' and history[50] == 'echo 49'
+  assert history.search_back('echo 1', len(history)) == 20